@@ -0,0 +1,67 @@
+import numpy as np
+
+from measureresult import band_edges
+
+
+def refine_targets(freqs, s21, params):
+    # frequencies worth a dense look: kp crossings of the coarse trace and the border frequencies, Hz
+    edges = band_edges(freqs, s21, [params['kp']])[0]
+    targets = [f for f in edges if not np.isnan(f)]
+    targets += [params['Fborder1'] * 1_000_000_000, params['Fborder2'] * 1_000_000_000]
+    return targets
+
+
+def refined_grid(freqs, targets, fine_step, width):
+    # coarse grid with dense fine_step windows of +-width around every target; window points sit on
+    # the fine_step lattice from the first coarse point so they match a dense linear sweep
+    freqs = np.asarray(freqs, dtype=float)
+    start, stop = freqs[0], freqs[-1]
+
+    windows = []
+    for f in sorted(targets):
+        lo = max(start, start + np.floor((f - width - start) / fine_step) * fine_step)
+        hi = min(stop, start + np.ceil((f + width - start) / fine_step) * fine_step)
+        if lo > hi:
+            continue
+        if windows and lo <= windows[-1][1]:
+            windows[-1][1] = max(windows[-1][1], hi)
+        else:
+            windows.append([lo, hi])
+
+    # coarse points closer than half a fine step to a window are left to the window lattice,
+    # frequencies are snapped to whole Hz so float noise cannot leave near duplicates
+    keep = np.ones(len(freqs), dtype=bool)
+    parts = []
+    for lo, hi in windows:
+        keep &= (freqs < lo - fine_step / 2) | (freqs > hi + fine_step / 2)
+        n = int(round((hi - lo) / fine_step)) + 1
+        parts.append(lo + np.arange(n) * fine_step)
+    return np.unique(np.round(np.concatenate([freqs[keep]] + parts)))
+
+
+def segments(grid, rtol=1e-6):
+    # splits a sorted grid into runs of equal spacing: [(points, start, stop), ...],
+    # frequencies are whole Hz so rounding the lattice may shift a step by 1 Hz
+    grid = np.round(np.asarray(grid, dtype=float))
+    out = []
+    i = 0
+    while i < len(grid):
+        j = i + 1
+        if j < len(grid):
+            step = grid[j] - grid[i]
+            while j + 1 < len(grid) and abs((grid[j + 1] - grid[j]) - step) <= max(rtol * step, 1):
+                j += 1
+            # a lone point between two runs starts the next run instead of closing this one
+            if j + 1 < len(grid) and j - i == 1 and out:
+                j = i
+        else:
+            j = i
+        out.append((j - i + 1, grid[i], grid[j]))
+        i = j + 1
+    return out
+
+
+def segment_list_command(grid):
+    segs = segments(grid)
+    data = ','.join(f'1,{n},{start:.0f},{stop:.0f}' for n, start, stop in segs)
+    return f'SENS1:SEGM:LIST SSTOP,{len(segs)},{data}'
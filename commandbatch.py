@@ -0,0 +1,54 @@
+# collects SCPI commands for one instrument: consecutive writes are joined with ';' into one message,
+# pending writes go out together with the next query, several queries are sent as one compound query
+# and the ';'-separated reply is split back into values
+class CommandBatch:
+
+    def __init__(self, instr, max_length=240):
+        self._instr = instr
+        self._max_length = max_length
+        self._pending = list()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.flush()
+
+    def send(self, command):
+        if self._pending and len(self._join(self._pending + [command])) > self._max_length:
+            self.flush()
+        self._pending.append(command)
+
+    def flush(self):
+        if self._pending:
+            self._instr.send(self._join(self._pending))
+            self._pending.clear()
+
+    def query(self, question):
+        return self.query_many([question])[0]
+
+    def query_many(self, questions):
+        message = self._join(self._pending + list(questions))
+        if len(message) > self._max_length:
+            self.flush()
+            message = self._join(questions)
+        self._pending.clear()
+        reply = self._instr.query(message)
+        values = [parse_value(v) for v in str(reply).strip().split(';')]
+        if len(values) != len(questions):
+            raise ValueError(f'expected {len(questions)} values in reply to "{message}", got "{reply}"')
+        return values
+
+    @staticmethod
+    def _join(commands):
+        # every command after the first starts from the root of the SCPI tree
+        return ';'.join(c if i == 0 or c.startswith((':', '*')) else f':{c}' for i, c in enumerate(commands))
+
+
+def parse_value(value):
+    value = value.strip()
+    try:
+        return float(value)
+    except ValueError:
+        return value
@@ -50,10 +50,14 @@ class ConnectionWidget(QWidget):
                                         {k: w.address for k, w in self._widgets.items()}))
 
     def connectTaskComplete(self):
+        for w, s in zip(self._widgets.values(), self._controller.status):
+            w.status = s
+
         if not self._controller.found:
+            failed = {k: v for k, v in self._controller.find_report.items() if not v['found']}
+            for k, v in failed.items():
+                print(f'{k} not found ({v["time"]:.2f} s) {v["error"]}')
             print('connect error, check connection')
             return
 
-        for w, s in zip(self._widgets.values(), self._controller.status):
-            w.status = s
         self.connected.emit()
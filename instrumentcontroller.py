@@ -1,14 +1,40 @@
+import threading
 import time
 
+import numpy as np
+
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+
 from os.path import isfile
-from PyQt5.QtCore import QObject, pyqtSlot
+from PyQt5.QtCore import QObject, pyqtSlot, pyqtSignal, QRunnable, QThreadPool, QTimer
 
 from arduino.programmerfactory import ProgrammerFactory
+from commandbatch import CommandBatch
+from iorecorder import IoLog, RecordingInstrument, health_thread
 from instr.instrumentfactory import AnalyzerFactory, mock_enabled, SourceFactory, GeneratorFactory, OscilloscopeFactory
+from adaptivesweep import refine_targets, refined_grid, segment_list_command
 from measureresult import MeasureResult
+from pipeline import run_pipeline
+from simulator import simulated_instruments
+from sweepmodel import SweepModel
+
+
+class StatsTask(QRunnable):
+
+    def __init__(self, fn, *args, **kwargs):
+        super().__init__()
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+
+    def run(self):
+        self.fn(*self.args, **self.kwargs)
 
 
 class InstrumentController(QObject):
+
+    statsUpdated = pyqtSignal(str)
+
     def __init__(self, parent=None):
         super().__init__(parent=parent)
 
@@ -29,7 +55,9 @@ class InstrumentController(QObject):
                 'P1': 15,
                 'P2': 21,
                 'Istat': [None, None, None],
-                'Idyn': [None, None, None]
+                'Idyn': [None, None, None],
+                # limit mask segments, see limitmask.LimitMask
+                'limits': [],
             },
         }
 
@@ -48,35 +76,230 @@ class InstrumentController(QObject):
             'Fborder2': 8
         }
 
+        # last analyzer settings sent by _init, empty means the analyzer needs a preset
+        self._pna_state = dict()
+
         self.sweep_points = 201
-        self.cal_set = 'CH1_CALREG'
+        self.if_bandwidth = 1000
+        self._cal_set = 'CH1_CALREG'
+
+        # 'linear' sweeps sweep_points evenly, 'adaptive' takes a coarse_points sweep first and then sweeps
+        # a segment list that is as dense as a fine_points linear sweep only within refine_width GHz
+        # of the coarse kp crossings and the border frequencies
+        self.sweep_type = 'linear'
+        self.coarse_points = 101
+        self.fine_points = 1601
+        self.refine_width = 0.05
+        self.refine_log = list()
+
+        # trace transfer format: 'ASCII', 'REAL,32' or 'REAL,64'; byte order: 'NORM' (big endian) or 'SWAP'
+        self.data_format = 'REAL,64'
+        self.byte_order = 'SWAP'
+
+        # sweep completion: 'sleep' - free running sweep + fixed delays, 'opc' - *OPC? after a triggered sweep,
+        # 'wai' - *WAI after trigger, 'srq' - wait for service request on operation complete
+        self.sweep_sync = 'opc'
+        self.sweep_delay = 0.5
+        self.sweep_log = list()
+
+        # sweeps taken per measurement and acquired ahead of result processing
+        self.sweep_reads = 3
+
+        # repeated sweeps: 'fixed' takes sweep_reads of them, 'converge' sweeps until the standard error
+        # of S21 and phase is below average_tolerance (dB, deg) or average_max sweeps are taken,
+        # 'analyzer' has the analyzer average average_count sweeps and reads the trace once
+        self.averaging = 'converge'
+        self.average_tolerance = (0.03, 0.3)
+        self.average_max = 16
+        self.average_count = 8
+        self.pipeline_depth = 2
+        # stop acquisition once a state violates a hard limit of the device mask
+        self.stop_on_fail = True
+
+        # supply current settle detection for the presence check, readings taken before
+        # settle_min_time has passed never count as settled
+        self.settle_min_time = 0.05
+        self.settle_poll_interval = 0.02
+        self.settle_tolerance = 0.02
+        self.settle_window = 3
+        self.settle_timeout = 0.5
+        self.settle_log = list()
+        # time source and sleeps of the time based loops and the 'sleep' sweep sync,
+        # a replay swaps in the recorded clock and skips the sleeps
+        self._clock = time.perf_counter
+        self._sleep = time.sleep
+
+        # instrument discovery: worker count, default probe timeout and per-instrument overrides, s
+        self.find_workers = 4
+        self.find_timeout = 5
+        self.find_timeouts = dict()
+        self.find_report = dict()
+
+        # session pool: live handles are kept between connects and probed every health_interval seconds
+        self.health_interval = 10
+        self._dead = set()
+        self._io_lock = threading.RLock()
+        self._health_stop = threading.Event()
+        self._health_thread = None
 
         self._instruments = dict()
+        self._io_log = None
         self.found = False
         self.present = False
         self.hasResult = False
 
         self.result = MeasureResult()
 
+        # secondary parameter changes are collected for stats_debounce ms, then stats are re-evaluated
+        # on a worker thread; only the latest request is reported; the result is only touched under
+        # _result_lock, a re-evaluation requested during a measurement waits for it to finish
+        self.stats_debounce = 100
+        self._stats_generation = 0
+        self._result_lock = threading.RLock()
+        self._stats_threads = QThreadPool()
+        self._stats_timer = QTimer(self)
+        self._stats_timer.setSingleShot(True)
+        self._stats_timer.timeout.connect(self._reevaluate_stats)
+
+        if isfile('./simulator.ini'):
+            with open('./simulator.ini', 'rt', encoding='utf-8') as f:
+                self.use_simulator(f.read().strip() or 'default')
+
     def __str__(self):
         return f'{self._instruments}'
 
+    def use_simulator(self, profile='default'):
+        # replaces the real instruments with the in-process simulator, see simulator.profiles
+        print(f'using simulated instruments, profile: {profile}')
+        self.requiredInstruments = simulated_instruments(profile)
+        self._instruments = dict()
+        self._dead.clear()
+        self.invalidate_setup()
+
     def connect(self, addrs):
         print(f'searching for {addrs}')
-        for k, v in addrs.items():
-            self.requiredInstruments[k].addr = v
-        self.found = self._find()
+        with self._io_lock:
+            for k, v in addrs.items():
+                if self.requiredInstruments[k].addr != v:
+                    self._close(k, self._instruments.pop(k, None))
+                self.requiredInstruments[k].addr = v
+            self.found = self._find()
+        if self.found:
+            self._start_health_check()
 
     def _find(self):
-        self._instruments = {
-            k: v.find() for k, v in self.requiredInstruments.items()
-        }
+        # only missing or dead sessions are probed, live ones are reused as is
+        names = [k for k in self.requiredInstruments if not self._instruments.get(k) or k in self._dead]
+        for k in names:
+            self.find_report.pop(k, None)
+            # a dead session still holds its port (serial ports are exclusive), release it before probing
+            self._close(k, self._instruments.get(k))
+            self._instruments[k] = None
+        pool = ThreadPoolExecutor(max_workers=self.find_workers)
+        # each timeout runs from the moment its probe leaves the pool queue
+        started = {k: threading.Event() for k in names}
+        begun = dict()
+
+        def probe(name):
+            begun[name] = time.perf_counter()
+            started[name].set()
+            return self._probe(self.requiredInstruments[name])
+
+        futures = {k: pool.submit(probe, k) for k in names}
+
+        for k, future in futures.items():
+            timeout = self.find_timeouts.get(k, self.find_timeout)
+            try:
+                # a probe still queued after its own timeout is stuck behind hung ones
+                if not started[k].wait(timeout) and future.cancel():
+                    raise TimeoutError
+                started[k].wait()
+                instr, elapsed, error = future.result(timeout=max(0, begun[k] + timeout - time.perf_counter()))
+            except TimeoutError:
+                instr, elapsed, error = None, timeout, f'timeout {timeout} s'
+            self._instruments[k] = instr
+            if k == 'Анализатор':
+                self.invalidate_setup()
+            self.find_report[k] = {'found': bool(instr), 'time': elapsed, 'error': error}
+            if instr:
+                self._dead.discard(k)
+            print(f'{k}: {"found" if instr else "not found"} in {elapsed:.3f} s {error}')
+
+        # do not wait for hung probes, their results are discarded
+        pool.shutdown(wait=False)
+        self._instruments = {k: self._instruments.get(k) for k in self.requiredInstruments}
         return all(self._instruments.values())
 
+    def _start_health_check(self):
+        if self._health_thread and self._health_thread.is_alive():
+            return
+        self._health_stop.clear()
+        self._health_thread = threading.Thread(target=self._health_loop, daemon=True, name=health_thread)
+        self._health_thread.start()
+
+    def stop_health_check(self):
+        self._health_stop.set()
+
+    def _health_loop(self):
+        while not self._health_stop.wait(self.health_interval):
+            # skip the round if a check or measurement holds the bus
+            if not self._io_lock.acquire(blocking=False):
+                continue
+            try:
+                self._check_sessions()
+            finally:
+                self._io_lock.release()
+
+    def _check_sessions(self):
+        for k, instr in self._instruments.items():
+            if instr and not self._is_alive(k, instr):
+                print(f'{k}: session lost')
+                self._dead.add(k)
+        if self._dead:
+            self.found = self._find()
+
+    @staticmethod
+    def _is_alive(name, instr):
+        try:
+            # the programmer speaks its own protocol, not SCPI: it is probed only if it has a ping
+            # and is assumed alive otherwise, VISA instruments answer *IDN?
+            ping = getattr(instr, 'ping', None)
+            if callable(ping):
+                return ping() is not False
+            if name == 'Программатор':
+                return True
+            return bool(instr.query('*IDN?'))
+        except Exception:
+            return False
+
+    @staticmethod
+    def _close(name, instr):
+        close = getattr(instr, 'close', None)
+        if not callable(close):
+            return
+        try:
+            close()
+        except Exception as ex:
+            print(f'{name}: could not close session: {ex}')
+
+    def _ensure_sessions(self):
+        if self._dead or not all(self._instruments.values()):
+            self.found = self._find()
+
+    @staticmethod
+    def _probe(factory):
+        start = time.perf_counter()
+        try:
+            return factory.find(), time.perf_counter() - start, ''
+        except Exception as ex:
+            return None, time.perf_counter() - start, str(ex)
+
     def check(self, params):
         print(f'call check with {params}')
         device, secondary = params
-        self.present = self._check(device, secondary)
+        with self._io_lock:
+            self._ensure_sessions()
+            self.present = self._check(device, secondary)
         print('sample pass')
 
     def _check(self, device, secondary):
@@ -88,50 +311,77 @@ class InstrumentController(QObject):
         src1 = self._instruments['Источник 1']
         prog = self._instruments['Программатор']
 
-        src1.send(f'apply p6v,{3.15}V,{5}mA')
-        # src1.set_voltage(chan=1, value=3.15, unit='V')
-        # src1.set_current(chan=1, value=5, unit='mA')
-
-        src1.send(f'apply p25v,{3.15}V,{30}mA')
-        # src1.set_voltage(chan=2, value=3.15, unit='V')
-        # src1.set_current(chan=2, value=30, unit='mA')
+        with CommandBatch(src1) as batch:
+            batch.send(f'apply p6v,{3.15}V,{5}mA')
+            # src1.set_voltage(chan=1, value=3.15, unit='V')
+            # src1.set_current(chan=1, value=5, unit='mA')
 
-        src1.send(f'inst:sel p6v; outp on')
-        src1.send(f'inst:sel p25v; outp on')
-        # src1.set_output(chan=2, state='ON')
-        # src1.set_output(chan=1, state='ON')
+            batch.send(f'apply p25v,{3.15}V,{30}mA')
+            # src1.set_voltage(chan=2, value=3.15, unit='V')
+            # src1.set_current(chan=2, value=30, unit='mA')
 
-        time.sleep(0.5)
+            batch.send(f'inst:sel p6v; outp on')
+            batch.send(f'inst:sel p25v; outp on')
+            # src1.set_output(chan=2, state='ON')
+            # src1.set_output(chan=1, state='ON')
 
-        current_ch1 = src1.send(f'MEAS:CURR? P6V')
-        current_ch2 = src1.send(f'MEAS:CURR? P25V')
-        total_current_before = current_ch1 + current_ch2
+        total_current_before, settle_before, settled_before = self._wait_current_settle(src1)
 
-        src1.send(f'apply p6v,{2.85}V,{5}mA')
-        src1.send(f'apply p25v,{2.85}V,{30}mA')
+        with CommandBatch(src1) as batch:
+            batch.send(f'apply p6v,{2.85}V,{5}mA')
+            batch.send(f'apply p25v,{2.85}V,{30}mA')
 
         prog.query('<u.41400000.DF080005>')
 
-        time.sleep(0.5)
+        total_current_after, settle_after, settled_after = self._wait_current_settle(src1)
 
-        current_ch1 = src1.send(f'MEAS:CURR? P6V')
-        current_ch2 = src1.send(f'MEAS:CURR? P25V')
-        # current_ch1 = src1.read_current(chan=1)
-        # current_ch2 = src1.read_current(chan=2)
-        total_current_after = current_ch1 + current_ch2
+        self.settle_log.append({
+            'before': settle_before,
+            'after': settle_after,
+            'timeout': not (settled_before and settled_after),
+        })
+        if settled_before and settled_after:
+            print(f'current settled in {settle_before:.3f} s / {settle_after:.3f} s')
+        else:
+            print(f'current settle timeout: {settle_before:.3f} s / {settle_after:.3f} s')
 
         drop = total_current_before / total_current_after
         return drop > 2
 
+    def _read_total_current(self, src):
+        current_ch1, current_ch2 = CommandBatch(src).query_many([f'MEAS:CURR? P6V', f'MEAS:CURR? P25V'])
+        # current_ch1 = src.read_current(chan=1)
+        # current_ch2 = src.read_current(chan=2)
+        return current_ch1 + current_ch2
+
+    def _wait_current_settle(self, src):
+        # poll until the last settle_window readings stay within settle_tolerance (relative) or timeout hits,
+        # -> (current, elapsed, settled)
+        start = self._clock()
+        readings = [self._read_total_current(src)]
+        while True:
+            elapsed = self._clock() - start
+            window = readings[-self.settle_window:]
+            if len(window) == self.settle_window and (elapsed >= self.settle_min_time or mock_enabled):
+                spread = max(window) - min(window)
+                if spread <= self.settle_tolerance * max(abs(v) for v in window):
+                    return window[-1], elapsed, True
+            if elapsed >= self.settle_timeout:
+                print(f'current did not settle in {self.settle_timeout} s')
+                return readings[-1], elapsed, False
+            if not mock_enabled:
+                self._sleep(self.settle_poll_interval)
+            readings.append(self._read_total_current(src))
+
     def measure(self, params):
         print(f'call measure with {params}')
         device, secondary = params
 
-        # TODO send measure results properly
-
-        self.result.raw_data = [1, 2, 3]
-        # self.hasResult = bool(self.result)
-        self.hasResult = True
+        with self._io_lock:
+            self._ensure_sessions()
+            with self._result_lock:
+                self._measure(device, secondary)
+                self.hasResult = bool(self.result)
 
     def _measure(self, device, secondary):
         param = self.deviceParams[device]
@@ -140,8 +390,18 @@ class InstrumentController(QObject):
 
         self._clear()
         self._init(secondary)
+        points = self._refine_grid(secondary) if self.sweep_type == 'adaptive' else self.sweep_points
 
-        return self._measure_s_params(secondary)
+        self.result.begin(points, secondary, *self._state_plan(), limits=param.get('limits', []),
+                          average=self.average_tolerance if self.averaging == 'converge' else None)
+        count = self._measure_s_params(secondary)
+        self.result.finalize()
+        return count
+
+    def _state_plan(self):
+        # phase and att codes of the sweeps taken by _acquire_sweeps, in order, at most
+        reads = {'converge': self.average_max, 'analyzer': 1}.get(self.averaging, self.sweep_reads)
+        return [0] * reads, [0] * reads
 
     def _clear(self):
         pass
@@ -150,38 +410,128 @@ class InstrumentController(QObject):
         pna = self._instruments['Анализатор']
         prog = self._instruments['Программатор']
 
-        pna.send('SYST:PRES')
-        pna.query('*OPC?')
-        # pna.send('SENS1:CORR ON')
+        if not self._pna_state:
+            pna.send('SYST:PRES')
+            pna.query('*OPC?')
+            # pna.send('SENS1:CORR ON')
 
-        pna.send('CALC1:PAR:DEF "CH1_S21",S21')
+            pna.send('CALC1:PAR:DEF "CH1_S21",S21')
 
-        # c:\program files\agilent\newtowrk analyzer\UserCalSets
-        pna.send(f'SENS1:CORR:CSET:ACT "{self.cal_set}",1')
+        self._send_setup(pna, self._pna_setup(pna, params))
 
-        pna.send(f'SENS1:SWE:POIN {self.sweep_points}')
+        prog.set_lpf_code(0)
 
-        pna.send(f'SENS1:FREQ:STAR {params["F1"]}GHz')
-        pna.send(f'SENS1:FREQ:STOP {params["F2"]}GHz')
+    def _send_setup(self, pna, setup):
+        # only settings that differ from the cached analyzer state are sent
+        try:
+            for key, commands in setup.items():
+                if self._pna_state.get(key) == commands:
+                    continue
+                for command in commands:
+                    pna.send(command)
+                self._pna_state[key] = commands
+        except Exception:
+            self.invalidate_setup()
+            raise
+
+    def _pna_setup(self, pna, params):
+        if self.sweep_sync == 'sleep':
+            sweep_mode = ('SENS1:SWE:MODE CONT', )
+        else:
+            sweep_mode = ('SENS1:SWE:MODE HOLD', 'INIT1:CONT OFF')
+
+        if self.averaging == 'analyzer':
+            averaging = (f'SENS1:AVER:COUN {self.average_count}', 'SENS1:AVER ON', f'SENS1:SWE:GRO:COUN {self.average_count}')
+        else:
+            averaging = ('SENS1:AVER OFF', )
+
+        return {
+            # c:\program files\agilent\newtowrk analyzer\UserCalSets
+            'cal_set': (f'SENS1:CORR:CSET:ACT "{self.cal_set}",1', ),
+            'sweep_type': ('SENS1:SWE:TYPE LIN', ),
+            'ifbw': (f'SENS1:BAND {self.if_bandwidth}', ),
+            'points': (f'SENS1:SWE:POIN {self.coarse_points if self.sweep_type == "adaptive" else self.sweep_points}', ),
+            'start': (f'SENS1:FREQ:STAR {params["F1"]}GHz', ),
+            'stop': (f'SENS1:FREQ:STOP {params["F2"]}GHz', ),
+            'sweep_mode': sweep_mode,
+            'averaging': averaging,
+            'format': (f'FORM:DATA {self._transfer_format(pna)}', ),
+            'byte_order': (f'FORM:BORD {self.byte_order}', ),
+        }
 
-        pna.send('SENS1:SWE:MODE CONT')
-        pna.send(f'FORM:DATA ASCII')
+    def _refine_grid(self, params):
+        # coarse stage of the adaptive sweep: one linear sweep locates the band edges,
+        # the analyzer is then switched to a segment sweep over the merged non-uniform grid
+        pna = self._instruments['Анализатор']
+        start = time.perf_counter()
 
-        prog.set_lpf_code(0)
+        self._wait_sweep(pna)
+        pna.send(f'CALC1:PAR:SEL "CH1_S21"')
+        pna.query('*OPC?')
+        coarse = self._fetch_trace(pna, 'CALC1:DATA:SNP? 2')
+        points = len(coarse) // 9
+        freqs, s21 = coarse[:points], coarse[3 * points:4 * points]
+
+        fine_step = (params['F2'] - params['F1']) * 1_000_000_000 / (self.fine_points - 1)
+        grid = refined_grid(freqs, refine_targets(freqs, s21, params), fine_step, self.refine_width * 1_000_000_000)
+        self._send_setup(pna, {
+            'sweep_type': ('SENS1:SWE:TYPE SEGM', ),
+            'segments': (segment_list_command(grid), ),
+        })
+
+        self.refine_log.append({'coarse': points, 'points': len(grid), 'time': time.perf_counter() - start})
+        print(f'adaptive sweep: {points} coarse points -> {len(grid)} points, {time.perf_counter() - start:.3f} s')
+        return len(grid)
+
+    def invalidate_setup(self):
+        # next _init starts from a preset and sends the full analyzer setup
+        self._pna_state.clear()
 
     def _measure_s_params(self, secondary):
         pna = self._instruments['Анализатор']
         prog = self._instruments['Программатор']
 
-        out = []
-
-        for _ in range(3):
-            if not mock_enabled:
-                time.sleep(0.5)
-
+        timing = {'sync': 0.0, 'count': 0}
+        start = time.perf_counter()
+        fmt = self._transfer_format(pna)
+
+        def process(raw):
+            # runs on the pipeline worker while the next sweep is acquired, the raw reply is dropped
+            # as soon as it is copied into the result buffer
+            self.result.add_state(self._decode_trace(fmt, raw))
+            timing['count'] += 1
+
+        run_pipeline(lambda wait: self._acquire_sweeps(pna, fmt, timing, wait), process, depth=self.pipeline_depth)
+
+        self._log_sweep_timing(timing['count'], timing['sync'], time.perf_counter() - start, fmt)
+        return timing['count']
+
+    def _acquire_sweeps(self, pna, fmt, timing, wait):
+        average = self.result.average
+        for index in range(len(self._state_plan()[0])):
+            if self.stop_on_fail and self.result.failed_hard:
+                print('hard limit violated, sweep stopped')
+                break
+
+            sync_start = time.perf_counter()
+            self._trigger_sweep(pna)
+            if average is not None and index:
+                # the sweep runs while the previous ones are processed; the decision is taken on exactly
+                # the sweeps before it, so the sweep count depends on the data only and a replay matches
+                wait(index)
+                if average.converged:
+                    if self.sweep_sync != 'sleep':
+                        pna.send('ABOR')
+                    s21_err, phase_err = average.standard_error
+                    print(f'averaging converged after {average.n} sweeps: {s21_err:.4f} dB, {phase_err:.3f} deg')
+                    break
+            self._complete_sweep(pna)
             pna.send(f'CALC1:PAR:SEL "CH1_S21"')
             pna.query('*OPC?')
-            res = pna.query(f'CALC1:DATA:SNP? 2')
+            # the sweep is timed up to the first blocking query: in 'wai' mode that is this *OPC?,
+            # held by the analyzer until the sweep is done, so every mode logs the same sweep time
+            timing['sync'] += time.perf_counter() - sync_start
+            res = self._query_trace(pna, fmt, 'CALC1:DATA:SNP? 2')
 
             # pna.send(f'CALC:DATA:SNP:PORTs:Save "1,2", "d:/ksa/psm_att/s_{att_code}_{psm_code}.s2p"')
             # pna.send(f'MMEM:STOR "d:/ksa/psm_att1/s_{att_code}_{psm_code}.s2p"')
@@ -189,21 +539,177 @@ class InstrumentController(QObject):
             if mock_enabled:
                 # with open(f'ref/sample_data/s_{att_code}_{psm_code}.s2p', mode='rt', encoding='utf-8') as f:
                 #     res = list(f.readlines())[0].strip()
-                print(_)
-            out.append(parse_float_list(res))
-
+                print(index)
+            yield res
+
+            if self.sweep_sync == 'sleep' and not mock_enabled:
+                sync_start = time.perf_counter()
+                self._sleep(self.sweep_delay)
+                timing['sync'] += time.perf_counter() - sync_start
+
+    def _wait_sweep(self, pna):
+        self._trigger_sweep(pna)
+        self._complete_sweep(pna)
+
+    def _trigger_sweep(self, pna):
+        # analyzer averaging takes a group of average_count sweeps, the analyzer is back in hold when it is done
+        trigger = 'SENS1:AVER:CLE;SENS1:SWE:MODE GRO' if self.averaging == 'analyzer' else 'INIT1:IMM'
+        if self.sweep_sync == 'sleep':
+            return
+        elif self.sweep_sync == 'wai':
+            # the following query is held by the analyzer until the sweep is done
+            pna.send(f'{trigger};*WAI')
+        elif self.sweep_sync == 'srq' and hasattr(pna, 'wait_for_srq'):
+            pna.send('*CLS;*ESE 1;*SRE 32')
+            pna.send(f'{trigger};*OPC')
+        else:
+            pna.send(trigger)
+
+    def _complete_sweep(self, pna):
+        if self.sweep_sync == 'sleep':
             if not mock_enabled:
-                time.sleep(0.5)
-        return out
+                self._sleep(self.sweep_delay)
+        elif self.sweep_sync == 'wai':
+            return
+        elif self.sweep_sync == 'srq' and hasattr(pna, 'wait_for_srq'):
+            pna.wait_for_srq()
+        else:
+            pna.query('*OPC?')
+
+    def _log_sweep_timing(self, reads, sync_time, total_time, fmt='ASCII'):
+        # fixed delays of the legacy path: always 3 reads with two sweep_delay sleeps each,
+        # and what the same delays would cost for the reads taken now
+        legacy_time = 0.0 if mock_enabled else 3 * 2 * self.sweep_delay
+        fixed_time = 0.0 if mock_enabled else reads * 2 * self.sweep_delay
+        saved = legacy_time - sync_time
+        # setup and noise go along with the timings so SweepModel can be calibrated from the log
+        average = self.result.average
+        self.sweep_log.append({
+            'mode': self.sweep_sync,
+            'reads': reads,
+            'sync': sync_time,
+            'total': total_time,
+            'saved': saved,
+            'legacy': legacy_time,
+            'saved_same_reads': fixed_time - sync_time,
+            'points': len(self.result.freqs),
+            'ifbw': self.if_bandwidth,
+            'format': fmt,
+            'sweeps': reads * (self.average_count if self.averaging == 'analyzer' else 1),
+            'noise': average.noise if average is not None and average.n else None,
+        })
+        print(f'sweep timing ({self.sweep_sync}): {reads} reads, wait {sync_time:.3f} s, total {total_time:.3f} s, '
+              f'saved {saved:.3f} s against the legacy {legacy_time:.3f} s, {fixed_time - sync_time:.3f} s for {reads} reads')
+
+    def sweep_model(self):
+        # time/noise model calibrated from the sweeps and current checks done so far
+        return SweepModel().calibrate(self.sweep_log, self.settle_log)
+
+    def estimate_time(self, states=1):
+        points = self.coarse_points if self.sweep_type == 'adaptive' else self.sweep_points
+        reads = {'converge': 1, 'analyzer': self.average_count}.get(self.averaging, self.sweep_reads)
+        fmt = self._transfer_format(self._instruments.get('Анализатор'))
+        return self.sweep_model().estimate(points, self.if_bandwidth, states, reads, fmt)
+
+    def suggest_setup(self, target_noise, states=1):
+        # fastest points / IF bandwidth / sweep count for target_noise (dB, deg) at no fewer points than now
+        fmt = self._transfer_format(self._instruments.get('Анализатор'))
+        setup = self.sweep_model().optimize(target_noise, states, min_points=self.sweep_points,
+                                            max_reads=self.average_max, fmt=fmt)
+        if setup:
+            print(f'suggested setup: {setup["points"]} points, IF {setup["ifbw"]} Hz, {setup["reads"]} sweeps, '
+                  f'{setup["time"]:.3f} s, noise {setup["noise"][0]:.4f} dB / {setup["noise"][1]:.3f} deg')
+        else:
+            print(f'no setup reaches {target_noise} within {self.average_max} sweeps')
+        return setup
+
+    def _transfer_format(self, pna):
+        # binary blocks need raw byte access to the instrument, fall back to text otherwise
+        if mock_enabled or not hasattr(pna, 'query_raw'):
+            return 'ASCII'
+        return self.data_format
+
+    def _fetch_trace(self, pna, question):
+        fmt = self._transfer_format(pna)
+        return self._decode_trace(fmt, self._query_trace(pna, fmt, question))
+
+    @staticmethod
+    def _query_trace(pna, fmt, question):
+        if fmt == 'ASCII':
+            return pna.query(question)
+        return pna.query_raw(question)
+
+    def _decode_trace(self, fmt, raw):
+        if fmt == 'ASCII':
+            return parse_float_list(raw)
+        return parse_binary_block(raw, fmt, self.byte_order)
+
+    def start_recording(self):
+        # wraps every instrument so its bus traffic is captured, see iorecorder.replay
+        with self._io_lock:
+            self._io_log = IoLog()
+            self._instruments = {k: RecordingInstrument(v, k, self._io_log) for k, v in self._instruments.items()}
+            # a recording always starts from a full analyzer setup so it can be replayed from scratch
+            self.invalidate_setup()
+
+    def stop_recording(self, path):
+        with self._io_lock:
+            self._instruments = {k: v._instr if isinstance(v, RecordingInstrument) else v for k, v in self._instruments.items()}
+            log, self._io_log = self._io_log, None
+        if log:
+            log.save(path)
+            print(f'saved {len(log.entries)} i/o records to {path}')
 
     @pyqtSlot(dict)
     def on_secondary_changed(self, params):
         self.secondaryParams = params
+        if self.hasResult:
+            self._stats_timer.start(self.stats_debounce)
+
+    def _reevaluate_stats(self):
+        self._stats_generation += 1
+        self._stats_threads.start(StatsTask(self._update_stats, dict(self.secondaryParams), self._stats_generation))
+
+    def _update_stats(self, params, generation):
+        with self._result_lock:
+            if generation != self._stats_generation or not self.result:
+                return
+            self.result.secondary_params = params
+            stats = self.result.stats
+        if generation == self._stats_generation:
+            self.statsUpdated.emit(stats)
+
+    @property
+    def stats(self):
+        with self._result_lock:
+            return self.result.stats
+
+    @property
+    def cal_set(self):
+        return self._cal_set
+
+    @cal_set.setter
+    def cal_set(self, value):
+        if value != self._cal_set:
+            self.invalidate_setup()
+        self._cal_set = value
 
     @property
     def status(self):
-        return [i.status for i in self._instruments.values()]
+        return [i.status if i else 'нет подключения' for i in self._instruments.values()]
 
 
 def parse_float_list(lst):
-    return [float(x) for x in lst.split(',')]
+    return np.fromstring(lst, sep=',')
+
+
+def parse_binary_block(raw, fmt='REAL,64', byte_order='SWAP'):
+    # IEEE 488.2 definite length block: #<n><n digits of length><data>[\n]
+    if raw[:1] != b'#':
+        raise ValueError(f'not a binary block: {raw[:16]}')
+    n = int(raw[1:2])
+    if n == 0:
+        raise ValueError('indefinite length blocks are not supported')
+    length = int(raw[2:2 + n])
+    dtype = np.dtype('f8' if fmt == 'REAL,64' else 'f4').newbyteorder('<' if byte_order == 'SWAP' else '>')
+    return np.frombuffer(raw, dtype=dtype, count=length // dtype.itemsize, offset=2 + n)
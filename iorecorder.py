@@ -0,0 +1,161 @@
+import base64
+import gzip
+import json
+import threading
+import time
+
+
+# instrument calls that go over the bus and are captured, wait_for_srq is recorded so that
+# a replay offers it too and the controller takes the same sweep sync branch
+recorded_methods = ('send', 'query', 'query_raw', 'set_lpf_code', 'wait_for_srq')
+
+# session health probes run on this thread, a replay does not repeat them
+health_thread = 'session-health'
+
+
+class IoLog:
+
+    def __init__(self, entries=None):
+        self.entries = list(entries or [])
+        self._start = time.perf_counter()
+        self._lock = threading.Lock()
+
+    def add(self, name, method, args, response, started, duration, thread=''):
+        with self._lock:
+            self.entries.append({
+                'i': name,
+                'm': method,
+                'a': list(args),
+                'r': _encode(response),
+                't': round(started - self._start, 6),
+                'dt': round(duration, 6),
+                'th': thread,
+            })
+
+    def save(self, path):
+        with gzip.open(path, mode='wt', encoding='utf-8') as f:
+            for e in self.entries:
+                f.write(json.dumps(e, ensure_ascii=False, separators=(',', ':')) + '\n')
+
+    @classmethod
+    def load(cls, path):
+        with gzip.open(path, mode='rt', encoding='utf-8') as f:
+            return cls(json.loads(line) for line in f if line.strip())
+
+    @property
+    def bus_time(self):
+        return sum(e['dt'] for e in self.entries)
+
+
+class RecordingInstrument:
+
+    def __init__(self, instr, name, log):
+        self._instr = instr
+        self._name = name
+        self._log = log
+
+    def __getattr__(self, item):
+        attr = getattr(self._instr, item)
+        if item not in recorded_methods:
+            return attr
+
+        def recorded(*args):
+            started = time.perf_counter()
+            response = attr(*args)
+            self._log.add(self._name, item, args, response, started, time.perf_counter() - started,
+                          threading.current_thread().name)
+            return response
+
+        return recorded
+
+    @property
+    def status(self):
+        return self._instr.status
+
+
+class ReplayClock:
+    # virtual time of a replay in the recording's time base: the end of the last replayed call,
+    # time based loops of the controller see the same elapsed times as when they were recorded
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class ReplayInstrument:
+
+    def __init__(self, name, entries, realtime=False, clock=None):
+        self._name = name
+        self._entries = entries
+        self._pos = 0
+        self._realtime = realtime
+        self._clock = clock
+        self._methods = {e['m'] for e in entries}
+        self.status = f'{name} (воспроизведение)'
+
+    def __getattr__(self, item):
+        if item not in self._methods:
+            raise AttributeError(item)
+        return lambda *args: self._replay(item, list(args))
+
+    def _replay(self, method, args):
+        # calls are replayed strictly in the recorded order
+        if self._pos >= len(self._entries):
+            raise LookupError(f'{self._name}: no recorded {method}{tuple(args)}, recording ended at entry {self._pos}')
+        e = self._entries[self._pos]
+        if e['m'] != method or e['a'] != args:
+            raise LookupError(f'{self._name}: expected {e["m"]}{tuple(e["a"])} at entry {self._pos}, got {method}{tuple(args)}')
+        self._pos += 1
+        if self._realtime:
+            time.sleep(e['dt'])
+        if self._clock:
+            self._clock.now = e['t'] + e['dt']
+        return _decode(e['r'])
+
+
+def replay_instruments(log, realtime=False, clock=None):
+    entries = [e for e in log.entries if e.get('th') != health_thread]
+    names = dict.fromkeys(e['i'] for e in entries)
+    return {n: ReplayInstrument(n, [e for e in entries if e['i'] == n], realtime, clock) for n in names}
+
+
+def replay(controller, path, device, realtime=False):
+    # runs a recorded check + measurement through the controller, splitting its own CPU time from bus time;
+    # the controller clock follows the recording, its sleeps are skipped unless replaying in real time
+    log = IoLog.load(path)
+    clock = ReplayClock()
+    controller._instruments = replay_instruments(log, realtime, clock)
+    controller.invalidate_setup()
+    controller._clock = clock
+    if not realtime:
+        controller._sleep = lambda seconds: None
+
+    wall = time.perf_counter()
+    cpu = time.process_time()
+    try:
+        controller._check(device, controller.secondaryParams)
+        controller._measure(device, controller.secondaryParams)
+    finally:
+        controller._clock = time.perf_counter
+        controller._sleep = time.sleep
+    cpu = time.process_time() - cpu
+    wall = time.perf_counter() - wall
+
+    print(f'replay {path}: wall {wall:.3f} s, controller cpu {cpu:.3f} s, recorded bus time {log.bus_time:.3f} s')
+    return {'wall': wall, 'cpu': cpu, 'bus': log.bus_time}
+
+
+def _encode(value):
+    if isinstance(value, (bytes, bytearray)):
+        return {'b64': base64.b64encode(value).decode('ascii')}
+    if value is None or isinstance(value, (str, int, float, bool)):
+        return value
+    return str(value)
+
+
+def _decode(value):
+    if isinstance(value, dict) and 'b64' in value:
+        return base64.b64decode(value['b64'])
+    return value
@@ -0,0 +1,75 @@
+import numpy as np
+
+
+# quantities a mask segment can limit; per state ones are checked as states arrive,
+# the rest once the whole result is available; errors are limited by absolute value
+state_quantities = ('s21', 'vswr_in', 'vswr_out')
+result_quantities = ('phase_err', 's21_err', 'phase_rmse', 's21_rmse')
+
+
+class LimitMask:
+    # segments come from deviceParams[device]['limits']:
+    #   {'F': [Fmin, Fmax] GHz, 's21': [min, max], 'vswr_in': [None, max], ..., 'hard': True}
+    # None means no limit on that side, hard segments stop the sweep on the first violation
+
+    def __init__(self, segments):
+        self.segments = list(segments or [])
+        self._grid = None
+        self._lo = dict()
+        self._hi = dict()
+        self._hard = dict()
+
+    def __bool__(self):
+        return bool(self.segments)
+
+    def compile(self, grid):
+        # per point lower/upper limit arrays for every quantity, built once per frequency grid
+        if self._grid is grid:
+            return
+        self._grid = grid
+        freqs = grid.freqs
+        points = len(freqs)
+        self._lo, self._hi, self._hard = dict(), dict(), dict()
+        for seg in self.segments:
+            f1, f2 = seg['F']
+            mask = (freqs >= f1 * 1_000_000_000) & (freqs <= f2 * 1_000_000_000)
+            for q in state_quantities + result_quantities:
+                if q not in seg:
+                    continue
+                lo, hi = seg[q]
+                if q not in self._lo:
+                    self._lo[q] = np.full(points, -np.inf)
+                    self._hi[q] = np.full(points, np.inf)
+                    self._hard[q] = np.zeros(points, dtype=bool)
+                if lo is not None:
+                    self._lo[q][mask] = np.maximum(self._lo[q][mask], lo)
+                if hi is not None:
+                    self._hi[q][mask] = np.minimum(self._hi[q][mask], hi)
+                self._hard[q][mask] |= bool(seg.get('hard', False))
+
+    def check(self, quantity, values):
+        # -> list of (quantity, freq Hz, value, hard) for the worst violating point, empty if within limits;
+        # if that point is in a soft segment the worst point violating a hard segment is reported as well
+        if quantity not in self._lo:
+            return []
+        values = np.atleast_2d(values)
+        # positive excess means the value is outside [lo, hi]
+        excess = np.maximum(self._lo[quantity] - values, values - self._hi[quantity])
+        point_excess = excess.max(axis=0)
+        bad = point_excess > 0
+        if not bad.any():
+            return []
+        hard = self._hard[quantity]
+        points = [int(np.argmax(point_excess))]
+        if not hard[points[0]] and (bad & hard).any():
+            points.append(int(np.argmax(np.where(bad & hard, point_excess, -np.inf))))
+        return [self._failure(quantity, values, excess, point) for point in points]
+
+    def _failure(self, quantity, values, excess, point):
+        worst = values[int(np.argmax(excess[:, point])), point]
+        return quantity, float(self._grid.freqs[point]), float(worst), bool(self._hard[quantity][point])
+
+
+def format_failure(failure):
+    quantity, freq, value, hard = failure
+    return f'{quantity} = {value:.02f} на {freq / 1_000_000_000:.02f} ГГц{" (жёсткий)" if hard else ""}'
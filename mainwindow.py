@@ -1,5 +1,5 @@
 from PyQt5 import uic
-from PyQt5.QtWidgets import QMainWindow
+from PyQt5.QtWidgets import QMainWindow, QLabel
 from PyQt5.QtCore import Qt, pyqtSignal, pyqtSlot
 
 from formlayout.formlayout import fedit
@@ -29,10 +29,12 @@ class MainWindow(QMainWindow):
         self._measureWidget = MeasureWidgetWithSecondaryParameters(parent=self, controller=self._instrumentController)
         self._measureModel = MeasureModel(parent=self, controller=self._instrumentController)
         self._sParamPlotWidget = SParamPlotWidget(parent=self, result=self._instrumentController.result)
+        self._labelStats = QLabel(parent=self)
 
         # init UI
         self._ui.layInstrs.insertWidget(0, self._connectionWidget)
         self._ui.layInstrs.insertWidget(1, self._measureWidget)
+        self._ui.layInstrs.insertWidget(2, self._labelStats)
 
         self._ui.tabWidget.insertTab(0, self._sParamPlotWidget, 'S-параметры')
         self._init()
@@ -42,6 +44,7 @@ class MainWindow(QMainWindow):
         self._connectionWidget.connected.connect(self._measureWidget.on_instrumentsConnected)
 
         self._measureWidget.secondaryChanged.connect(self._instrumentController.on_secondary_changed)
+        self._instrumentController.statsUpdated.connect(self.on_statsUpdated)
 
         self._measureWidget.measureStarted.connect(self.on_measureStarted)
         self._measureWidget.measureComplete.connect(self._measureModel.update)
@@ -69,10 +72,15 @@ class MainWindow(QMainWindow):
     @pyqtSlot()
     def on_measureComplete(self):
         print('meas complete')
+        self._labelStats.setText(self._instrumentController.stats)
 
         # TODO tmp disable
         # self._sParamPlotWidget.plot()
 
+    @pyqtSlot(str)
+    def on_statsUpdated(self, stats):
+        self._labelStats.setText(stats)
+
     @pyqtSlot()
     def on_measureStarted(self):
         self._sParamPlotWidget.clear()
@@ -85,16 +93,19 @@ class MainWindow(QMainWindow):
             ('Калибровка', self._instrumentController.cal_set),
             ('Только основные', only_main_states),
             ('Набор для коррекции', [1, '+25', '+85', '-60']),
+            ('Сбросить анализатор', False),
         ]
 
         values = fedit(data=data, title='Параметры')
         if not values:
             return
 
-        adjust, cal_set, only_main_states, adjust_set = values
+        adjust, cal_set, only_main_states, adjust_set, preset = values
 
         # self._instrumentController.result.adjust = adjust
         # self._instrumentController.result.adjust_set = adjust_set
         self._instrumentController.cal_set = cal_set
+        if preset:
+            self._instrumentController.invalidate_setup()
         # self._sParamPlotWidget.only_main_states = only_main_states
 
@@ -1,66 +1,78 @@
-import itertools
-import math
 import random
-import statistics
+
+import numpy as np
+
+from concurrent.futures import ProcessPoolExecutor
+from statistics import NormalDist
+from limitmask import LimitMask, format_failure
+from touchstone import load_set
 
 
 # TODO add midpoint for stats calculations
 # TODO att response - adjust phase values
 
-def chunks(lst, n):
-    for i in range(0, len(lst), n):
-        yield lst[i:i + n]
-
-
-def unwrap(xw):
-    dist = 180
-    xu = list(xw)
-    for i in range(1, len(xw)):
-        diff = xw[i] - xw[i - 1]
-        if diff > dist:
-            for j in range(i, len(xu)):
-                xu[j] -= 2 * dist
-        elif diff < -dist:
-            for j in range(i, len(xu)):
-                xu[j] += 2 * dist
+# row layout of a single SNP? 2 trace block: freq, s11 db/deg, s21 db/deg, s12 db/deg, s22 db/deg
+SNP_ROWS = 9
+
+
+def unwrap(xw, threshold=180, period=360):
+    # unwraps every row of xw at once: each jump larger than threshold between neighbouring
+    # points shifts the rest of the row by one period, corrections are accumulated in one pass
+    xw = np.asarray(xw, dtype=float)
+    diff = np.diff(xw, axis=-1)
+    steps = np.where(diff > threshold, -period, 0) + np.where(diff < -threshold, period, 0)
+    xu = xw.copy()
+    xu[..., 1:] += np.cumsum(steps, axis=-1)
     return xu
 
 
-def calc_vswr(in_mags: list):
-    temp = map(lambda x: x / 20, in_mags)
-    modulated = list(map(lambda x: pow(10, x), temp))
-    plus = map(lambda x: 1 + x, modulated)
-    minus = map(lambda x: 1 - x, modulated)
-    out = map(lambda x: x[0] / x[1], zip(plus, minus))
-    return list(out)
+def calc_vswr(in_mags):
+    modulated = np.power(10, np.asarray(in_mags, dtype=float) / 20)
+    return (1 + modulated) / (1 - modulated)
 
 
-def calc_error(array, zero):
-    return [a - z for a, z in zip(array, zero)]
+def to_complex(db, deg):
+    return np.power(10, np.asarray(db, dtype=float) / 20) * np.exp(1j * np.deg2rad(deg))
 
 
-def calc_error_around_ideal(array, mean, ideal):
-    return [a - m - ideal for a, m in zip(array, mean)]
+def vswr_from_complex(s):
+    gamma = np.abs(s)
+    return (1 + gamma) / (1 - gamma)
 
 
-def calc_phase_error(array, zero, ideal):
-    return [a - z - ideal if (a - z - ideal) > -200 else (a - z - ideal + 360) for a, z in zip(array, zero)]
+def loss_from_complex(s):
+    # return / insertion loss, positive dB
+    with np.errstate(divide='ignore'):
+        return -20 * np.log10(np.abs(s))
 
 
-def calc_rmse_phase(values, mean):
-    return math.sqrt(sum(pow(v, 2) for v in values) / len(values))
+def group_delay(s, freqs):
+    # -dφ/dω along the last axis, s
+    phase = np.unwrap(np.angle(s), axis=-1)
+    return -np.gradient(phase, 2 * np.pi * np.asarray(freqs, dtype=float), axis=-1)
 
 
-def calc_rmse_amp(values, mean):
-    return math.sqrt(sum(pow(v, 2) for v in values) / len(values))
+def linear_phase_deviation(s, freqs):
+    # unwrapped phase minus its least squares straight line fit over the band, deg
+    phase = np.rad2deg(np.unwrap(np.angle(s), axis=-1))
+    x = np.asarray(freqs, dtype=float)
+    x = x - x.mean()
+    y_mean = phase.mean(axis=-1, keepdims=True)
+    slope = ((phase - y_mean) * x).sum(axis=-1, keepdims=True) / np.square(x).sum()
+    return phase - y_mean - slope * x
 
 
-def shift_vals(values, shift):
-    return [s + shift for s in values]
+def calc_error(array, zero):
+    return array - zero
 
 
-def mul_vals(values, shift):
-    return [s * shift for s in values]
+def calc_error_around_ideal(array, mean, ideal):
+    return array - mean - ideal
+
+
+def calc_phase_error(array, zero, ideal):
+    err = array - zero - ideal
+    return np.where(err > -200, err, err + 360)
 
 
 def generateValue(data):
@@ -70,13 +82,75 @@ def generateValue(data):
     return round(random.randint(0, int((stop - start) / step)) * step + start, 2)
 
 
-def sub_ph0(phs, ph0s):
-    return [a - b for a, b in zip(phs, ph0s)]
-
-
-def _find_freq_index(freqs: list, freq):
-    freq = freq * 1_000_000_000
-    return min(range(len(freqs)), key=lambda i: abs(freqs[i] - freq))
+def band_edges(freqs, envelope, levels):
+    # longest run of points above each level, edges linearly interpolated to the level crossing;
+    # returns (levels x 2) array of (low, high) frequencies, nan where there is no run
+    freqs = np.asarray(freqs, dtype=float)
+    envelope = np.asarray(envelope, dtype=float)
+    levels = np.asarray(levels, dtype=float)
+    out = np.full((len(levels), 2), np.nan)
+    if not len(envelope) or not len(levels):
+        return out
+
+    above = np.pad(envelope > levels[:, None], ((0, 0), (1, 1))).astype(np.int8)
+    steps = np.diff(above, axis=1)
+    # starts and ends come out in row major order, so they pair up run by run
+    level_idx, starts = np.nonzero(steps == 1)
+    _, ends = np.nonzero(steps == -1)
+    if not len(starts):
+        return out
+
+    # longest run per level, the first one on ties
+    order = np.lexsort((starts, starts - ends, level_idx))
+    rows, first = np.unique(level_idx[order], return_index=True)
+    starts = starts[order][first]
+    ends = ends[order][first] - 1
+
+    def crossing(lo, hi, level):
+        # lo == hi at the grid ends, those values are discarded by np.where below
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return freqs[lo] + (level - envelope[lo]) * (freqs[hi] - freqs[lo]) / (envelope[hi] - envelope[lo])
+
+    last = len(envelope) - 1
+    lv = levels[rows]
+    out[rows, 0] = np.where(starts > 0, crossing(np.maximum(starts - 1, 0), starts, lv), freqs[starts])
+    out[rows, 1] = np.where(ends < last, crossing(ends, np.minimum(ends + 1, last), lv), freqs[ends])
+    return out
+
+
+class FrequencyGrid:
+    # sweep frequency grid, Hz, built once per run: nearest point lookups by bisection
+    # and linear interpolation of traces at arbitrary frequencies, works on non-uniform grids
+
+    def __init__(self, freqs):
+        self.freqs = np.asarray(freqs, dtype=float)
+        if np.any(np.diff(self.freqs) < 0):
+            raise ValueError('frequency grid must be sorted')
+
+    def __len__(self):
+        return len(self.freqs)
+
+    def indices(self, freqs):
+        # nearest grid point for every target, the lower one on ties
+        freqs = np.asarray(freqs, dtype=float)
+        right = np.clip(np.searchsorted(self.freqs, freqs), 1, len(self.freqs) - 1)
+        left = right - 1
+        return np.where(freqs - self.freqs[left] <= self.freqs[right] - freqs, left, right)
+
+    def index(self, freq):
+        if len(self.freqs) == 1:
+            return 0
+        return int(self.indices(freq))
+
+    def interp(self, trace, freqs):
+        # trace is (..., points), targets outside the grid are clamped to the end points
+        trace = np.asarray(trace, dtype=float)
+        freqs = np.clip(np.asarray(freqs, dtype=float), self.freqs[0], self.freqs[-1])
+        right = np.clip(np.searchsorted(self.freqs, freqs), 1, len(self.freqs) - 1)
+        left = right - 1
+        span = self.freqs[right] - self.freqs[left]
+        weight = np.divide(freqs - self.freqs[left], span, out=np.zeros_like(freqs), where=span > 0)
+        return trace[..., left] * (1 - weight) + trace[..., right] * weight
 
 
 bitmap = [0, 1 << 0, 1 << 1, 1 << 2, 1 << 3, 1 << 4, 1 << 5]
@@ -91,6 +165,159 @@ def phs_value_for_phs_code(code):
     return code * 5.625
 
 
+class RunningStats:
+    # per frequency point running mean, variance and extremes: Welford update for single rows,
+    # Chan's merge for blocks of rows, numerically stable and filled once per state
+
+    def __init__(self, points):
+        self.n = 0
+        self.mean = np.zeros(points)
+        self._m2 = np.zeros(points)
+        self.min = np.full(points, np.inf)
+        self.max = np.full(points, -np.inf)
+
+    def add(self, row):
+        row = np.asarray(row, dtype=float)
+        self.n += 1
+        delta = row - self.mean
+        self.mean += delta / self.n
+        self._m2 += delta * (row - self.mean)
+        np.minimum(self.min, row, out=self.min)
+        np.maximum(self.max, row, out=self.max)
+
+    def add_rows(self, rows):
+        rows = np.asarray(rows, dtype=float)
+        if not len(rows):
+            return
+        n = len(rows)
+        mean = rows.mean(axis=0)
+        m2 = np.square(rows - mean).sum(axis=0)
+        total = self.n + n
+        delta = mean - self.mean
+        self.mean = self.mean + delta * n / total
+        self._m2 = self._m2 + m2 + np.square(delta) * self.n * n / total
+        self.n = total
+        np.minimum(self.min, rows.min(axis=0), out=self.min)
+        np.maximum(self.max, rows.max(axis=0), out=self.max)
+
+    @property
+    def variance(self):
+        return self._m2 / self.n
+
+    @property
+    def std(self):
+        return np.sqrt(self.variance)
+
+    @property
+    def rms(self):
+        return np.sqrt(np.square(self.mean) + self.variance)
+
+
+def average_sweeps(data, threshold=180):
+    # (sweeps x rows x points) repeated sweeps of one state -> (1 x rows x points) mean, magnitudes
+    # are averaged in dB, phases on the unit circle so the wrap points do not matter
+    mean = data.mean(axis=0)
+    phase_rows = [2, 4, 6, 8]
+    mean[phase_rows] = np.degrees(np.angle(np.exp(1j * np.radians(data[:, phase_rows])).mean(axis=0)))
+    mean[4] = unwrap(mean[4], threshold=threshold)
+    return mean[np.newaxis]
+
+
+class SweepAverage:
+    # running average of repeated sweeps of one state; converged once the standard error of S21, dB
+    # and of its phase, deg, is below tolerance at all but the noisiest (100 - percentile)% of points;
+    # phase is taken relative to the first sweep on the circle, so sweeps unwrapped a period apart agree
+
+    def __init__(self, points, tolerance, percentile=95):
+        self.tolerance = tolerance
+        self.percentile = percentile
+        self._s21 = RunningStats(points)
+        self._phase = RunningStats(points)
+        self._ref = None
+        self._single = (np.inf, np.inf)
+
+    def add(self, block):
+        if self._ref is None:
+            self._ref = block[4].copy()
+            self._single = (single_sweep_noise(block[3]), single_sweep_noise(block[4]))
+        self._s21.add(block[3])
+        self._phase.add((block[4] - self._ref + 180) % 360 - 180)
+
+    @property
+    def n(self):
+        return self._s21.n
+
+    @property
+    def s21(self):
+        return self._s21.mean
+
+    @property
+    def phase(self):
+        return self._ref + self._phase.mean if self._ref is not None else self._phase.mean
+
+    @property
+    def standard_error(self):
+        n = self.n
+        if n < 2:
+            # no per point spread yet, the single sweep estimate stands for every point
+            return self._single
+        # with few sweeps the per point variances scatter as chi-square with n - 1 degrees of freedom,
+        # their percentile is divided by that of the chi-square so uniform noise reads as sigma / sqrt(n)
+        spread = chi2_quantile(self.percentile / 100, n - 1) / (n - 1)
+        return tuple(float(np.sqrt(np.percentile(stats.variance * n / (n - 1), self.percentile) / spread / n))
+                     for stats in (self._s21, self._phase))
+
+    @property
+    def noise(self):
+        # noise of a single sweep pooled over the grid, dB and deg
+        n = self.n
+        if n < 2:
+            return self._single
+        return tuple(float(np.sqrt(np.mean(stats.variance * n / (n - 1)))) for stats in (self._s21, self._phase))
+
+    @property
+    def converged(self):
+        return self.n > 0 and all(e <= t for e, t in zip(self.standard_error, self.tolerance))
+
+
+def chi2_quantile(p, dof):
+    # Wilson-Hilferty approximation, within a few percent down to one degree of freedom
+    z = NormalDist().inv_cdf(p)
+    return dof * (1 - 2 / (9 * dof) + z * np.sqrt(2 / (9 * dof))) ** 3
+
+
+def single_sweep_noise(trace):
+    # noise of one sweep from the median second difference, smooth trends cancel out,
+    # sigma(d2) = sqrt(6) sigma and median(|x|) = 0.6745 sigma for gaussian noise
+    d2 = np.diff(trace, n=2)
+    return float(np.median(np.abs(d2)) / 0.6745 / np.sqrt(6)) if len(d2) else np.inf
+
+
+def process_adjust_set(directory, phase_codes, att_codes, secondary):
+    # runs in a worker process, only the compact arrays travel back
+    result = MeasureResult()
+    result.adjust = True
+    result._adjust_dir = directory
+    result.raw_data = [0, [], phase_codes, att_codes, secondary]
+    return result.compact()
+
+
+def adjust_drift(results, reference):
+    # worst s21 error and phase rmse of every set minus the reference set, on the reference grid
+    ref = results[reference]
+    ref_s21_err = np.abs(ref['s21_err']).max(axis=0)
+    drift = dict()
+    for key, res in results.items():
+        if key == reference:
+            continue
+        grid = FrequencyGrid(res['freqs'])
+        drift[key] = {
+            's21_err': grid.interp(np.abs(res['s21_err']).max(axis=0), ref['freqs']) - ref_s21_err,
+            'phase_rmse': grid.interp(res['phase_rmse'], ref['freqs']) - ref['phase_rmse'],
+        }
+    return drift
+
+
 class MeasureResult:
     adjust_dirs = {
         1: 'data/+25',
@@ -98,36 +325,39 @@ class MeasureResult:
         3: 'data/-60',
     }
 
+    # phase jump between adjacent points treated as a wrap, deg
+    unwrap_threshold = 180
+
+    # extra s21 levels the passband edges are reported for besides kp, dB
+    band_levels = (-1, -3, -9)
+
+    # derived value -> method computing it on first access, inputs whose change invalidates it
+    _derived = {
+        'grid': ('_calc_grid', {'data'}),
+        'acc': ('_accumulate', {'data'}),
+        'complex': ('_calc_complex', {'data'}),
+        'vswr_in': ('_calc_vwsr_in', {'data'}),
+        'vswr_out': ('_calc_vwsr_out', {'data'}),
+        'losses': ('_calc_losses', {'data'}),
+        'group_delay': ('_calc_group_delay', {'data'}),
+        'phase_linearity': ('_calc_phase_linearity', {'data'}),
+        'verdict': ('_check_limits', {'data', 'limits'}),
+        'phase_err': ('_calc_phase_err', {'data'}),
+        's21_err': ('_calc_s21_err', {'data'}),
+        'phase_rmse': ('_calc_phase_rmse', {'data'}),
+        's21_rmse': ('_calc_s21_rmse', {'data'}),
+        'stats': ('_calc_stats', {'data', 'borders'}),
+        'kp_band': ('_calc_band_edges', {'data', 'kp', 'levels'}),
+    }
+
     def __init__(self, ):
 
         self.headers = list()
         self._secondaryParams = dict()
 
-        self._freqs = list()
-        self._s21s = list()
-        self._s21s_err = list()
-        self._s21s_rmse = list()
-        self._s21s_ph = list()
-        self._s21s_ph_norm = list()
-        self._s21s_ph_err = list()
-        self._s21s_ph_rmse = list()
-        self._s11s = list()
-        self._s12s = list()
-        self._s22s = list()
         self._phase_codes = list()
         self._att_codes = list()
 
-        self._vswr_in = list()
-        self._vswr_out = list()
-
-        self._s21_mins = list()
-        self._vswr_in_max = list()
-        self._vswr_out_max = list()
-        self._phase_rmse_values = list()
-        self._s21_rmse_values = list()
-        self._phase_err_max = list()
-        self._s21_err_max = list()
-
         self._misc = list()
 
         self._kp_freq_min = 0
@@ -137,46 +367,93 @@ class MeasureResult:
         self._max_freq_index = 0
 
         self.adjust = False
+        self.adjust_all = False
         self._adjust_dir = self.adjust_dirs[1]
         self.ready = False
+        self._adjust_results = dict()
+        self._adjust_drift = dict()
+
+        self._limits = LimitMask(None)
+
+        self._points = 0
+        self._count = 0
+        self._buffer = None
+        self._valid = set()
+
+        self._init()
 
     def __bool__(self):
         return self.ready
 
     def _init(self):
         self._secondaryParams.clear()
-        self._freqs.clear()
-        self._s21s.clear()
-        self._s21s_err.clear()
-        self._s21s_rmse.clear()
-        self._s21s_ph.clear()
-        self._s21s_ph_norm.clear()
-        self._s21s_ph_err.clear()
-        self._s21s_ph_rmse.clear()
-        self._s11s.clear()
-        self._s12s.clear()
-        self._s22s.clear()
         self._phase_codes.clear()
         self._att_codes.clear()
 
-        self._vswr_in.clear()
-        self._vswr_out.clear()
+        self._set_data(np.empty((0, SNP_ROWS, 0)))
+
+        self._s21s_err = np.empty((0, 0))
+        self._s21s_rmse = np.empty(0)
+        self._s21s_ph_norm = np.empty((0, 0))
+        self._s21s_ph_err = np.empty((0, 0))
+        self._s21s_ph_rmse = np.empty(0)
+
+        self._vswr_in = np.empty((0, 0))
+        self._vswr_out = np.empty((0, 0))
+
+        self._s_complex = np.empty((4, 0, 0), dtype=complex)
+        self._return_loss_in = np.empty((0, 0))
+        self._return_loss_out = np.empty((0, 0))
+        self._insertion_loss = np.empty((0, 0))
+        self._group_delay = np.empty((0, 0))
+        self._phase_linearity = np.empty((0, 0))
+
+        self._grid = None
+        self._mask_grid = None
+        self._failures = list()
+        self.failed_hard = False
+        self._s21_acc = None
+        self._ph_err_acc = None
+        self._plan = None
+        self.average = None
 
-        self._s21_mins.clear()
-        self._vswr_in_max.clear()
-        self._vswr_out_max.clear()
-        self._phase_rmse_values.clear()
-        self._s21_rmse_values.clear()
-        self._phase_err_max.clear()
-        self._s21_err_max.clear()
+        self._s21_mins = list()
+        self._vswr_in_max = list()
+        self._vswr_out_max = list()
+        self._phase_rmse_values = list()
+        self._s21_rmse_values = list()
+        self._phase_err_max = list()
+        self._s21_err_max = list()
 
         self._kp_freq_min = 0
         self._kp_freq_max = 0
+        self._band_edges = dict()
 
         self._misc.clear()
 
-    def _process(self):
-        self._unwrap_phase()
+    def _set_data(self, data):
+        # single (states x SNP_ROWS x points) buffer, all traces are views into it
+        self._data = np.ascontiguousarray(data, dtype=float)
+        self._freqs = self._data[0, 0] if len(self._data) else np.empty(0)
+        self._s11s = self._data[:, 1]
+        self._s21s = self._data[:, 3]
+        self._s21s_ph = self._data[:, 4]
+        self._s12s = self._data[:, 5]
+        self._s22s = self._data[:, 7]
+        self._invalidate('data')
+
+    def _derive(self, name):
+        if name not in self._valid:
+            getattr(self, self._derived[name][0])()
+            self._valid.add(name)
+
+    def _invalidate(self, *inputs):
+        inputs = set(inputs)
+        self._valid = {n for n in self._valid if not self._derived[n][1] & inputs}
+
+    def _process(self, unwrapped=False):
+        if not unwrapped:
+            self._unwrap_phase()
         self._normalize_phase()
         # if self.adjust:
         #     self._adjust_data('s21')
@@ -184,175 +461,184 @@ class MeasureResult:
         # self._calc_vwsr_out()
         # if self.adjust:
         #     self._adjust_data('vswr')
-        self._calc_phase_err()
-        self._calc_s21_err()
         # if self.adjust:
         #     self._adjust_data('err')
-        self._calc_phase_rmse()
-        self._calc_s21_rmse()
-
-        self._calc_stats()
 
-        # self._cal_s21_worst_loss()
-        #
+        # errors, rmse, vswr and stats are derived on first access, see _derived
+        self._invalidate('data')
         self.ready = True
 
+    def _calc_grid(self):
+        self._grid = FrequencyGrid(self._freqs)
+
     def _unwrap_phase(self):
-        self._s21s_ph = [unwrap(s) for s in self._s21s_ph]
+        self._s21s_ph[:] = unwrap(self._s21s_ph, threshold=self.unwrap_threshold)
 
     def _normalize_phase(self):
-        ph0 = self._s21s_ph[0]
-        self._s21s_ph_norm = [sub_ph0(ph, ph0) for ph in self._s21s_ph]
+        self._s21s_ph_norm = self._s21s_ph - self._s21s_ph[0]
+
+    def _calc_complex(self):
+        # S11, S21, S12, S22 as (4 x states x points) complex array from the dB/deg row pairs
+        self._s_complex = to_complex(self._data[:, 1::2], self._data[:, 2::2]).swapaxes(0, 1)
 
     def _calc_vwsr_in(self):
-        self._vswr_in = [calc_vswr(s) for s in self._s11s]
+        self._derive('complex')
+        self._vswr_in = vswr_from_complex(self._s_complex[0])
 
     def _calc_vwsr_out(self):
-        self._vswr_out = [calc_vswr(s) for s in self._s22s]
+        self._derive('complex')
+        self._vswr_out = vswr_from_complex(self._s_complex[3])
 
-    def _calc_phase_err(self):
+    def _calc_losses(self):
+        self._derive('complex')
+        self._return_loss_in = loss_from_complex(self._s_complex[0])
+        self._insertion_loss = loss_from_complex(self._s_complex[1])
+        self._return_loss_out = loss_from_complex(self._s_complex[3])
+
+    def _calc_group_delay(self):
+        self._derive('complex')
+        self._group_delay = group_delay(self._s_complex[1], self._freqs)
+
+    def _calc_phase_linearity(self):
+        self._derive('complex')
+        self._phase_linearity = linear_phase_deviation(self._s_complex[1], self._freqs)
+
+    def _att_group_len(self):
+        return len(set(self._att_codes))
+
+    def _s21_amps(self):
+        # first state of every attenuator group
+        return self._s21s[::self._att_group_len()]
+
+    def _phase_error_rows(self):
         unique_phase_codes = sorted(set(self._phase_codes))
         phase_group_len = len(unique_phase_codes)
         s21_phases = self._s21s_ph[:phase_group_len]
         ph0 = s21_phases[0]
-        phase_values = [phs_value_for_phs_code(c) for c in unique_phase_codes]
+        phase_values = np.array([phs_value_for_phs_code(c) for c in unique_phase_codes])[:len(s21_phases), None]
 
         # TODO check against the datasheet if the error calc is correct
 
-        self._s21s_ph_err = [calc_phase_error(s, ph0, ideal) for s, ideal in zip(s21_phases, phase_values)]
+        return calc_phase_error(s21_phases, ph0, phase_values)
 
-        means = [statistics.mean(vs) for vs in zip(*self._s21s_ph_err)]
-        self._s21s_ph_err = [calc_error(s, mean) for s, mean in zip(self._s21s_ph_err, itertools.repeat(means, len(self._s21s_ph_err)))]
+    def _accumulate(self):
+        if self._accumulated():
+            return
+        points = self._freqs.shape[0]
+        self._s21_acc = RunningStats(points)
+        self._s21_acc.add_rows(self._s21_amps())
+        self._ph_err_acc = RunningStats(points)
+        self._ph_err_acc.add_rows(self._phase_error_rows())
+
+    def _accumulated(self):
+        # accumulators filled state by state are valid only while the states arrive as planned
+        if self._s21_acc is None or self._plan is None:
+            return False
+        count = len(self._phase_codes)
+        return self._plan[0][:count] == self._phase_codes and self._plan[1][:count] == self._att_codes
+
+    def _calc_phase_err(self):
+        self._derive('acc')
+        self._s21s_ph_err = calc_error(self._phase_error_rows(), self._ph_err_acc.mean)
 
     def _calc_s21_err(self):
         unique_att_codes = sorted(set(self._att_codes))
-        att_group_len = len(unique_att_codes)
         # att_values = [0, 0.25, 0.5, 1, 2, 4, 8, 15.75]
-        att_values = [att_value_for_att_code(c) for c in unique_att_codes]
+        att_values = np.array([att_value_for_att_code(c) for c in unique_att_codes])
 
-        s21_amps = [chunk[0] for chunk in chunks(self._s21s, att_group_len)]
+        self._derive('acc')
+        s21_amps = self._s21_amps()
+        rows = min(len(s21_amps), len(att_values))
 
-        means = [statistics.mean(vs) for vs in zip(*s21_amps)]
-        self._s21s_err = [calc_error_around_ideal(s, means, a) for s, a in zip(s21_amps, att_values)]
+        self._s21s_err = calc_error_around_ideal(s21_amps[:rows], self._s21_acc.mean, att_values[:rows, None])
 
     def _calc_phase_rmse(self):
-        means = [statistics.mean(vs) for vs in zip(*self._s21s_ph_err)]
-        for *vs, mean in zip(*self._s21s_ph_err, means):
-            self._s21s_ph_rmse.append(calc_rmse_phase(vs, mean))
+        # errors are centered on the per point mean, so their rms is the standard deviation
+        self._derive('acc')
+        self._s21s_ph_rmse = self._ph_err_acc.std
 
     def _calc_s21_rmse(self):
-        # TODO refactor this dupe
-        unique_att_codes = set(self._att_codes)
-        att_group_len = len(unique_att_codes)
-
-        s21_amps = [chunk[0] for chunk in chunks(self._s21s, att_group_len)]
-
-        means = [statistics.mean(vs) for vs in zip(*s21_amps)]
-        for *vs, mean in zip(*s21_amps, means):
-            self._s21s_rmse.append(calc_rmse_amp(vs, mean))
+        self._derive('acc')
+        self._s21s_rmse = self._s21_acc.rms
 
     def _adjust_data(self, what):
         if what == 'err':
             err_mul = random.uniform(0.875, 1.125)
-            self._s21s_err = [mul_vals(s, err_mul) for s in self._s21s_err]
-            self._s21s_ph_err = [mul_vals(s, err_mul) for s in self._s21s_ph_err]
+            self._s21s_err = self._s21s_err * err_mul
+            self._s21s_ph_err = self._s21s_ph_err * err_mul
         elif what == 's21':
             s21_shift = random.uniform(-0.2, 0.2)
-            self._s21s = [shift_vals(s, s21_shift) for s in self._s21s]
+            self._s21s += s21_shift
         elif what == 'vswr':
             vswr_in_shift = random.uniform(-0.05, 0.05)
             vswr_out_shift = random.uniform(-0.05, 0.05)
-            self._vswr_in = [shift_vals(s, vswr_in_shift) for s in self._vswr_in]
-            self._vswr_out = [shift_vals(s, vswr_out_shift) for s in self._vswr_out]
+            self._vswr_in = self._vswr_in + vswr_in_shift
+            self._vswr_out = self._vswr_out + vswr_out_shift
         else:
             return
 
     def _calc_stats(self):
-        self._min_freq_index = _find_freq_index(self._freqs, self._secondaryParams['Fborder1'])
-        self._max_freq_index = _find_freq_index(self._freqs, self._secondaryParams['Fborder2'])
-
-        mid = self._min_freq_index + abs(self._max_freq_index - self._min_freq_index) // 2
+        self._derive('acc')
+        self._derive('grid')
+        self._min_freq_index, self._max_freq_index = self._grid.indices(
+            [self._secondaryParams['Fborder1'] * 1_000_000_000, self._secondaryParams['Fborder2'] * 1_000_000_000]).tolist()
 
-        unique_att_codes = set(self._att_codes)
-        att_group_len = len(unique_att_codes)
-        s21_amps = [chunk[0] for chunk in chunks(self._s21s, att_group_len)]
+        # midpoint by frequency, not by index: adaptive sweeps give a non-uniform grid
+        self._mid_freq_index = self._grid.index((self._freqs[self._min_freq_index] + self._freqs[self._max_freq_index]) / 2)
+        idx = [self._min_freq_index, self._mid_freq_index, self._max_freq_index]
 
-        vs = list(zip(*s21_amps))
-        self._s21_mins = [min(vs[self._min_freq_index]), min(vs[mid]), min(vs[self._max_freq_index])]
+        self._s21_mins = self._s21_acc.min[idx].tolist()
 
-        # vs = list(zip(*self.vswr_in))
-        # self._vswr_in_max = [max(vs[self._min_freq_index]), max(vs[mid]), max(vs[self._max_freq_index])]
-        #
-        # vs = list(zip(*self.vswr_out))
-        # self._vswr_out_max = [max(vs[self._min_freq_index]), max(vs[mid]), max(vs[self._max_freq_index])]
-        #
-        # self._phase_rmse_values = [self.phase_rmse[self._min_freq_index], self.phase_rmse[mid], self.phase_rmse[self._max_freq_index]]
-        # self._s21_rmse_values = [self.s21_rmse[self._min_freq_index], self.s21_rmse[mid], self.s21_rmse[self._max_freq_index]]
+        # self._vswr_in_max = self.vswr_in[:, idx].max(axis=0).tolist()
+        # self._vswr_out_max = self.vswr_out[:, idx].max(axis=0).tolist()
         #
-        # vs = list(zip(*self.phase_err))
-        # self._phase_err_max = [max(abs(v) for v in vs[self._min_freq_index]), max(abs(v) for v in vs[mid]), max(abs(v) for v in vs[self._max_freq_index])]
+        # self._phase_rmse_values = self.phase_rmse[idx].tolist()
+        # self._s21_rmse_values = self.s21_rmse[idx].tolist()
         #
-        # vs = list(zip(*self.s21_err))
-        # self._s21_err_max = [max(abs(v) for v in vs[self._min_freq_index]), max(abs(v) for v in vs[mid]), max(abs(v) for v in vs[self._max_freq_index])]
-
-    def _cal_s21_worst_loss(self):
-        min_index = _find_freq_index(self._freqs, self._secondaryParams['Fborder1'])
-        max_index = _find_freq_index(self._freqs, self._secondaryParams['Fborder2'])
-
-        # min_index = 0
-        # max_index = len(self._freqs) - 1
-
-        level = self._secondaryParams['kp']
-        mins = [min(vals) for vals in zip(*self._s21s)]
-        res = itertools.groupby(mins, key=lambda x: x > level)
-        res = [list(ls) for val, ls in res if val]
-        if not res:
-            self._kp_freq_min = 'n/a'
-            self._kp_freq_max = 'n/a'
-            return
-        elif len(res) != len(self._freqs):
-            max_size = max(len(el) for el in res)
-            res = list(filter(lambda x: len(x) == max_size, res))[0]
-            min_index = mins.index(res[0])
-            max_index = mins.index(res[-1])
-        self._kp_freq_min = round(self._freqs[min_index] / 1_000_000_000, 2)
-        self._kp_freq_max = round(self._freqs[max_index] / 1_000_000_000, 2)
+        # self._phase_err_max = np.abs(self.phase_err[:, idx]).max(axis=0).tolist()
+        # self._s21_err_max = np.abs(self.s21_err[:, idx]).max(axis=0).tolist()
+
+    def _calc_band_edges(self):
+        # Fн/Fв for kp and every extra band level in one pass over the worst case (min) s21 envelope
+        levels = [self._secondaryParams['kp']] + list(self.band_levels)
+        edges = band_edges(self._freqs, self._s21s.min(axis=0), levels)
+        self._band_edges = {level: (self._round_freq(lo), self._round_freq(hi)) for level, (lo, hi) in zip(levels[1:], edges[1:])}
+        self._kp_freq_min, self._kp_freq_max = (self._round_freq(f) for f in edges[0])
+
+    @staticmethod
+    def _round_freq(freq):
+        return 'n/a' if np.isnan(freq) else round(freq / 1_000_000_000, 2)
 
     def _load_ideal(self):
+        if self.adjust_all:
+            self._load_all_ideal()
+            return
+
         print(f'reading adjust set from: {self.adjust_set}/')
-        for i in range(64):
-            with open(f'{self.adjust_set}/s{i}.s2p', mode='rt', encoding='utf-8') as f:
-                fs = []
-                s11dbs = []
-                s11degs = []
-                s21dbs = []
-                s21degs = []
-                s12dbs = []
-                s12degs = []
-                s22dbs = []
-                s22degs = []
-
-                for line in list(f.readlines())[5:]:
-                    res = map(float, line.strip().split())
-                    frq, s11db, s11deg, s21db, s21deg, s12db, s12deg, s22db, s22deg = res
-                    fs.append(frq)
-                    s11dbs.append(s11db)
-                    s11degs.append(s11deg)
-                    s21dbs.append(s21db)
-                    s21degs.append(s21deg)
-                    s12dbs.append(s12db)
-                    s12degs.append(s12deg)
-                    s22dbs.append(s22db)
-                    s22degs.append(s22deg)
-
-            self._s11s.append(s11dbs)
-            self._s21s.append(s21dbs)
-            self._s21s_ph.append(s21degs)
-            self._s22s.append(s22dbs)
-
-        self._freqs = fs
+        # the loaded set is shared between runs, processing works on a copy
+        self._set_data(load_set(self.adjust_set)[:, :SNP_ROWS].copy())
         self._process()
 
+    def _load_all_ideal(self):
+        # the other temperature sets are processed on a process pool while the active one is processed here
+        others = {k: v for k, v in self.adjust_dirs.items() if v != self._adjust_dir}
+        args = (list(self._phase_codes), list(self._att_codes), dict(self._secondaryParams))
+        with ProcessPoolExecutor(max_workers=len(others) or 1) as pool:
+            futures = {k: pool.submit(process_adjust_set, v, *args) for k, v in others.items()}
+
+            self.adjust_all = False
+            try:
+                self._load_ideal()
+            finally:
+                self.adjust_all = True
+
+            results = {k: f.result() for k, f in futures.items()}
+
+        active = next((k for k, v in self.adjust_dirs.items() if v == self._adjust_dir), 0)
+        results[active] = self.compact()
+        self._adjust_results = dict(sorted(results.items()))
+        self._adjust_drift = adjust_drift(self._adjust_results, active)
+
     @property
     def raw_data(self):
         return True
@@ -372,24 +658,147 @@ class MeasureResult:
             self._load_ideal()
             return
 
-        for pars in s2p:
-            for i in range(9):
-                array = pars[i * points: i * points + points]
-                if i == 0:
-                    self._freqs = array
-                elif i == 1:
-                    self._s11s.append(array)
-                elif i == 3:
-                    self._s21s.append(array)
-                elif i == 4:
-                    self._s21s_ph.append(array)
-                elif i == 5:
-                    self._s12s.append(array)
-                elif i == 7:
-                    self._s22s.append(array)
-        # print(args)
+        s2p = np.array([pars[:SNP_ROWS * points] for pars in s2p], dtype=float)
+        self._set_data(s2p.reshape(len(s2p), SNP_ROWS, points))
         self._process()
 
+    def begin(self, points, secondary, phase_codes=None, att_codes=None, states=64, limits=None, average=None):
+        # incremental ingestion: begin -> add_state for every att/phase state -> finalize
+        # with the planned state codes known up front running stats are updated as states arrive,
+        # average=(dB, deg) tolerance treats the states as repeated sweeps and tracks their convergence
+        print('begin result')
+        self._init()
+        self.ready = False
+        self._points = int(points)
+        self._secondaryParams = dict(secondary)
+        self._plan = (list(phase_codes), list(att_codes)) if phase_codes is not None else None
+        if limits is not None:
+            self.limits = limits
+        self._count = 0
+        self.average = SweepAverage(self._points, average) if average else None
+        self._buffer = np.empty((max(len(self._plan[0]) if self._plan else states, 1), SNP_ROWS, self._points))
+
+    def add_state(self, trace, phase_code=None, att_code=None):
+        index = self._count
+        if index == len(self._buffer):
+            self._buffer = np.concatenate([self._buffer, np.empty_like(self._buffer)])
+
+        block = self._buffer[index]
+        block[:] = np.asarray(trace[:SNP_ROWS * self._points], dtype=float).reshape(SNP_ROWS, self._points)
+        block[4] = unwrap(block[4], threshold=self.unwrap_threshold)
+
+        planned = self._plan and index < len(self._plan[0])
+        self._phase_codes.append(phase_code if phase_code is not None else self._plan[0][index] if planned else 0)
+        self._att_codes.append(att_code if att_code is not None else self._plan[1][index] if planned else 0)
+        self._count += 1
+
+        # traces are views of the filled part of the buffer, partial data can be plotted
+        self._set_data(self._buffer[:self._count])
+        if planned:
+            self._update_running(index, block)
+        if self._limits:
+            self._check_state(index, block)
+        if self.average is not None:
+            self.average.add(block)
+
+    def _update_running(self, index, block):
+        phase_codes, att_codes = self._plan
+        if index == 0:
+            self._s21_acc = RunningStats(self._points)
+            self._ph_err_acc = RunningStats(self._points)
+
+        # same state selection as the batch _calc_* steps
+        if index % len(set(att_codes)) == 0:
+            self._s21_acc.add(block[3])
+
+        unique_phase_codes = sorted(set(phase_codes))
+        if index < len(unique_phase_codes):
+            self._ph_err_acc.add(calc_phase_error(block[4], self._buffer[0, 4], phs_value_for_phs_code(unique_phase_codes[index])))
+
+    def _check_state(self, index, block):
+        # per state limits are checked as soon as the state arrives, hard violations stop the sweep
+        if index == 0:
+            self._mask_grid = FrequencyGrid(block[0])
+            self._limits.compile(self._mask_grid)
+        values = {'vswr_in': calc_vswr(block[1]), 'vswr_out': calc_vswr(block[7])}
+        if index % len(set(self._plan[1] if self._plan else self._att_codes)) == 0:
+            values['s21'] = block[3]
+        for q, v in values.items():
+            for failure in self._limits.check(q, v):
+                print(f'state {index}: limit violated, {format_failure(failure)}')
+                self.failed_hard |= failure[3]
+
+    def _check_limits(self):
+        self._failures = list()
+        if not self._limits or not len(self._data):
+            return
+        self._limits.compile(self.grid)
+        values = {
+            's21': self._s21_amps(),
+            'vswr_in': self.vswr_in,
+            'vswr_out': self.vswr_out,
+            'phase_err': np.abs(self.phase_err),
+            's21_err': np.abs(self.s21_err),
+            'phase_rmse': self.phase_rmse,
+            's21_rmse': self.s21_rmse,
+        }
+        for q, v in values.items():
+            self._failures += self._limits.check(q, v)
+
+    @property
+    def limits(self):
+        return self._limits
+
+    @limits.setter
+    def limits(self, segments):
+        self._limits = segments if isinstance(segments, LimitMask) else LimitMask(segments)
+        self._invalidate('limits')
+
+    @property
+    def passed(self):
+        # None without a limit mask
+        if not self._limits:
+            return None
+        self._derive('verdict')
+        return not self._failures and not self.failed_hard
+
+    @property
+    def failures(self):
+        self._derive('verdict')
+        return [format_failure(f) for f in self._failures]
+
+    @property
+    def partial(self):
+        # running values over the states received so far
+        if self._s21_acc is None or not self._count:
+            return {'states': self._count}
+        self._derive('stats')
+        return {
+            'states': self._count,
+            's21_mean': self._s21_acc.mean,
+            's21_min': self._s21_acc.min,
+            's21_rmse': self._s21_acc.rms,
+            'phase_rmse': self._ph_err_acc.std,
+            's21_mins': self._s21_mins,
+        }
+
+    def finalize(self):
+        print('process result')
+        if self.adjust:
+            self._load_ideal()
+            return
+
+        data = self._buffer[:self._count]
+        if self.average is not None and self._count > 1:
+            # repeated sweeps of one state are kept as their mean, running stats are rebuilt from it
+            data = average_sweeps(data, self.unwrap_threshold)
+            del self._phase_codes[1:]
+            del self._att_codes[1:]
+            self._s21_acc = None
+        self._set_data(data)
+        self._buffer = None
+        self._process(unwrapped=True)
+
     @property
     def freqs(self):
         return self._freqs
@@ -412,12 +821,45 @@ class MeasureResult:
 
     @property
     def vswr_in(self):
+        self._derive('vswr_in')
         return self._vswr_in
 
     @property
     def vswr_out(self):
+        self._derive('vswr_out')
         return self._vswr_out
 
+    @property
+    def s_params(self):
+        # complex S11, S21, S12, S22, each (states x points)
+        self._derive('complex')
+        return self._s_complex
+
+    @property
+    def return_loss_in(self):
+        self._derive('losses')
+        return self._return_loss_in
+
+    @property
+    def return_loss_out(self):
+        self._derive('losses')
+        return self._return_loss_out
+
+    @property
+    def insertion_loss(self):
+        self._derive('losses')
+        return self._insertion_loss
+
+    @property
+    def group_delay(self):
+        self._derive('group_delay')
+        return self._group_delay
+
+    @property
+    def phase_linearity(self):
+        self._derive('phase_linearity')
+        return self._phase_linearity
+
     @property
     def phase(self):
         return self._s21s_ph
@@ -428,18 +870,22 @@ class MeasureResult:
 
     @property
     def phase_err(self):
+        self._derive('phase_err')
         return self._s21s_ph_err
 
     @property
     def phase_rmse(self):
+        self._derive('phase_rmse')
         return self._s21s_ph_rmse
 
     @property
     def s21_err(self):
+        self._derive('s21_err')
         return self._s21s_err
 
     @property
     def s21_rmse(self):
+        self._derive('s21_rmse')
         return self._s21s_rmse
 
     @property
@@ -454,11 +900,59 @@ class MeasureResult:
     def adjust_set(self, value):
         self._adjust_dir = self.adjust_dirs[value]
 
+    def compact(self):
+        # per frequency results as plain arrays, cheap to send between processes
+        return {
+            'freqs': np.array(self.freqs),
+            's21_err': np.asarray(self.s21_err),
+            'phase_err': np.asarray(self.phase_err),
+            's21_rmse': np.asarray(self.s21_rmse),
+            'phase_rmse': np.asarray(self.phase_rmse),
+            's21_min': self._s21s.min(axis=0),
+        }
+
+    @property
+    def adjust_results(self):
+        # {adjust_dirs key: compact()} for every temperature set, filled in adjust_all mode
+        return self._adjust_results
+
+    @property
+    def adjust_drift(self):
+        # {adjust_dirs key: per frequency drift against the active set}, filled in adjust_all mode
+        return self._adjust_drift
+
+    @property
+    def grid(self):
+        self._derive('grid')
+        return self._grid
+
+    @property
+    def band(self):
+        # {level: (Fн, Fв)} in GHz for band_levels, 'n/a' where s21 never rises above the level
+        self._derive('kp_band')
+        return self._band_edges
+
+    @property
+    def secondary_params(self):
+        return self._secondaryParams
+
+    @secondary_params.setter
+    def secondary_params(self, params):
+        # only the stats stage depends on these, unwrapped data and error matrices are kept
+        changed = {k for k, v in params.items() if self._secondaryParams.get(k) != v}
+        self._secondaryParams.update(params)
+        if changed & {'Fborder1', 'Fborder2'}:
+            self._invalidate('borders')
+        if 'kp' in changed:
+            self._invalidate('kp')
+
     @property
     def stats(self):
+        self._derive('stats')
+        self._derive('kp_band')
         low = self._min_freq_index
         high = self._max_freq_index
-        mid = low + (high - low) // 2
+        mid = self._mid_freq_index
         f1 = round(self.freqs[low] / 1_000_000_000, 2)
         f2 = round(self.freqs[mid] / 1_000_000_000, 2)
         f3 = round(self.freqs[high] / 1_000_000_000, 2)
@@ -517,4 +1011,11 @@ class MeasureResult:
 
 Верхняя граница РЧ, Fв:
 {kp_freq_max}
-'''
+''' + self._verdict_text()
+
+    def _verdict_text(self):
+        if self.passed is None:
+            return ''
+        if self.passed:
+            return '\nГоден\n'
+        return '\nНе годен:\n' + '\n'.join(self.failures) + '\n'
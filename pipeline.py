@@ -0,0 +1,47 @@
+import queue
+import threading
+
+
+_done = object()
+
+
+def run_pipeline(produce, consume, depth=2):
+    # items from produce(wait) are handed to consume() on a worker thread through a bounded queue,
+    # so producing item N overlaps with consuming item N-1; worker errors are re-raised here;
+    # wait(n) blocks the producer until the first n items are consumed or the worker failed
+    items = queue.Queue(maxsize=depth)
+    errors = []
+    consumed = [0]
+    progress = threading.Condition()
+
+    def wait(n):
+        with progress:
+            progress.wait_for(lambda: consumed[0] >= n or errors)
+
+    def worker():
+        while True:
+            item = items.get()
+            if item is _done:
+                return
+            try:
+                if not errors:
+                    consume(item)
+            except Exception as ex:
+                errors.append(ex)
+            with progress:
+                consumed[0] += 1
+                progress.notify_all()
+
+    thread = threading.Thread(target=worker, daemon=True)
+    thread.start()
+    try:
+        for item in produce(wait):
+            if errors:
+                break
+            items.put(item)
+    finally:
+        items.put(_done)
+        thread.join()
+
+    if errors:
+        raise errors[0]
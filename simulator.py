@@ -0,0 +1,392 @@
+import math
+import random
+import threading
+import time
+
+import numpy as np
+
+
+# latencies are in seconds, bus_rate in bytes/s, currents in A
+profiles = {
+    'default': {
+        'latency': 0.002,
+        'bus_rate': 800_000,
+        'point_time': 0.0001,
+        'preset_time': 1.5,
+        'cal_set_time': 0.8,
+        'noise_db': 0.02,
+        'noise_deg': 0.2,
+        'delay_ns': 1.2,
+        'loss_db': -6.5,
+        'band': (1.2, 4.3),
+        'current': 0.015,
+        'current_programmed': 0.004,
+        'current_noise': 0.00005,
+        'settle_tau': 0.03,
+        'programmer_latency': 0.01,
+        'reset_voltage': 3.0,
+        'ifbw': 1000,
+    },
+    'instant': {
+        'latency': 0.0,
+        'bus_rate': 0,
+        'point_time': 0.0,
+        'preset_time': 0.0,
+        'cal_set_time': 0.0,
+        'noise_db': 0.02,
+        'noise_deg': 0.2,
+        'delay_ns': 1.2,
+        'loss_db': -6.5,
+        'band': (1.2, 4.3),
+        'current': 0.015,
+        'current_programmed': 0.004,
+        'current_noise': 0.00005,
+        'settle_tau': 0.0,
+        'programmer_latency': 0.0,
+        'reset_voltage': 3.0,
+        'ifbw': 1000,
+    },
+    'noisy': {
+        'latency': 0.005,
+        'bus_rate': 100_000,
+        'point_time': 0.0002,
+        'preset_time': 3.0,
+        'cal_set_time': 1.5,
+        'noise_db': 0.3,
+        'noise_deg': 2.0,
+        'delay_ns': 2.5,
+        'loss_db': -7.0,
+        'band': (1.3, 4.1),
+        'current': 0.015,
+        'current_programmed': 0.004,
+        'current_noise': 0.0005,
+        'settle_tau': 0.15,
+        'programmer_latency': 0.02,
+        'reset_voltage': 3.0,
+        'ifbw': 1000,
+    },
+}
+
+
+def split_commands(message):
+    # ';' separates commands, a leading ':' only resets the SCPI path
+    return [c.strip().lstrip(':') for c in message.split(';') if c.strip()]
+
+
+class SimBench:
+    # state shared by the simulated instruments: what the DUT sees
+
+    def __init__(self, profile='default', seed=None):
+        self.profile = dict(profiles[profile]) if isinstance(profile, str) else dict(profile)
+        self.rnd = random.Random(seed)
+        self.programmed = False
+        self.powered = False
+        self.power_changed = time.perf_counter()
+        self.lpf_code = 0
+
+    def wait(self, seconds):
+        if seconds > 0:
+            time.sleep(seconds)
+
+    def supply_current(self):
+        p = self.profile
+        if not self.powered:
+            return 0.0
+        target = p['current_programmed'] if self.programmed else p['current']
+        other = p['current'] if self.programmed else p['current_programmed']
+        tau = p['settle_tau']
+        elapsed = time.perf_counter() - self.power_changed
+        k = math.exp(-elapsed / tau) if tau > 0 else 0.0
+        return target + (other - target) * k + self.rnd.gauss(0, p['current_noise'])
+
+
+class SimInstrument:
+
+    def __init__(self, bench, name):
+        self._bench = bench
+        self.name = name
+        self.status = f'{name} (симулятор)'
+
+    def __str__(self):
+        return self.status
+
+    def _turnaround(self, reply_size=0):
+        p = self._bench.profile
+        transfer = reply_size / p['bus_rate'] if p['bus_rate'] else 0
+        self._bench.wait(p['latency'] + transfer)
+
+    def send(self, message):
+        self._turnaround()
+        reply = None
+        for command in split_commands(message):
+            reply = self._handle(command)
+        return reply
+
+    def query(self, message):
+        # write commands in the message produce no reply, like on a real SCPI instrument
+        replies = [self._handle(c) for c in split_commands(message)]
+        reply = ';'.join(str(r) for r in replies if r is not None)
+        self._turnaround(len(reply))
+        return reply
+
+    def _handle(self, command):
+        if command.upper() == '*IDN?':
+            return f'Simulator,{self.name},0,1.0'
+        if command.upper() == '*OPC?':
+            return 1
+        return None
+
+
+class SimAnalyzer(SimInstrument):
+
+    def __init__(self, bench):
+        super().__init__(bench, 'PNA')
+        self.points = 201
+        self.start = 10e6
+        self.stop = 20e9
+        self.data_format = 'ASCII'
+        self.byte_order = 'NORM'
+        self.sweep_type = 'LIN'
+        self.segments = []
+        self.averaging = False
+        self.average_count = 1
+        self.group_count = 1
+        self.ifbw = bench.profile['ifbw']
+        self._pending_sweep = 0.0
+        self._held = False
+
+    def freqs(self):
+        if self.sweep_type == 'SEGM' and self.segments:
+            return np.concatenate([np.linspace(start, stop, n) for n, start, stop in self.segments])
+        return np.linspace(self.start, self.stop, self.points)
+
+    def _sweep_time(self):
+        # point_time is given at the profile IF bandwidth, a fifth of it does not depend on the bandwidth
+        p = self._bench.profile
+        return len(self.freqs()) * p['point_time'] * (0.2 + 0.8 * p['ifbw'] / self.ifbw)
+
+    def _handle(self, command):
+        cmd, _, arg = command.partition(' ')
+        cmd = cmd.upper()
+        p = self._bench.profile
+        if cmd == 'SYST:PRES':
+            self.points, self.start, self.stop = 201, 10e6, 20e9
+            self.data_format, self.byte_order = 'ASCII', 'NORM'
+            self.sweep_type, self.segments = 'LIN', []
+            self.averaging, self.average_count, self.group_count = False, 1, 1
+            self.ifbw = p['ifbw']
+            self._bench.wait(p['preset_time'])
+        elif cmd == 'SENS1:CORR:CSET:ACT':
+            self._bench.wait(p['cal_set_time'])
+        elif cmd == 'SENS1:SWE:POIN':
+            self.points = int(arg)
+        elif cmd == 'SENS1:FREQ:STAR':
+            self.start = _parse_freq(arg)
+        elif cmd == 'SENS1:FREQ:STOP':
+            self.stop = _parse_freq(arg)
+        elif cmd == 'SENS1:SWE:TYPE':
+            self.sweep_type = arg.strip().upper()
+        elif cmd == 'SENS1:SEGM:LIST':
+            self.segments = _parse_segments(arg)
+        elif cmd == 'SENS1:BAND':
+            self.ifbw = float(arg)
+        elif cmd == 'SENS1:AVER':
+            self.averaging = arg.strip().upper() in ('ON', '1')
+        elif cmd == 'SENS1:AVER:COUN':
+            self.average_count = int(arg)
+        elif cmd == 'SENS1:SWE:GRO:COUN':
+            self.group_count = int(arg)
+        elif cmd == 'SENS1:SWE:MODE' and arg.strip().upper() == 'GRO':
+            self._pending_sweep = self.group_count * self._sweep_time()
+        elif cmd == 'FORM:DATA':
+            self.data_format = arg.strip().upper()
+        elif cmd == 'FORM:BORD':
+            self.byte_order = arg.strip().upper()
+        elif cmd in ('INIT1:IMM', 'INIT1'):
+            self._pending_sweep = self._sweep_time()
+        elif cmd == 'ABOR':
+            self._pending_sweep = 0.0
+        elif cmd == '*WAI':
+            # like the analyzer: send returns at once, the next query is held until the sweep is done
+            self._held = True
+        elif cmd == '*OPC?':
+            self._finish_sweep()
+            return 1
+        elif cmd == 'CALC1:DATA:SNP?':
+            return ','.join(f'{v:.6e}' for v in self.snp())
+        return super()._handle(command)
+
+    def _finish_sweep(self):
+        self._bench.wait(self._pending_sweep)
+        self._pending_sweep = 0.0
+        self._held = False
+
+    def query(self, message):
+        if self._held:
+            self._finish_sweep()
+        return super().query(message)
+
+    def query_raw(self, message):
+        if self._held:
+            self._finish_sweep()
+        values = None
+        for command in split_commands(message):
+            if command.upper().startswith('CALC1:DATA:SNP?'):
+                values = self.snp()
+            else:
+                self._handle(command)
+        dtype = np.dtype('f8' if self.data_format == 'REAL,64' else 'f4').newbyteorder('<' if self.byte_order == 'SWAP' else '>')
+        data = values.astype(dtype).tobytes()
+        length = str(len(data))
+        raw = b'#' + str(len(length)).encode() + length.encode() + data + b'\n'
+        self._turnaround(len(raw))
+        return raw
+
+    def snp(self):
+        p = self._bench.profile
+        rnd = np.random.default_rng(self._bench.rnd.getrandbits(32))
+        # noise goes as sqrt of the IF bandwidth, averaged traces: noise of the mean of average_count sweeps
+        scale = math.sqrt(self.ifbw / p['ifbw'] / (self.average_count if self.averaging else 1))
+        freqs = self.freqs()
+        points = len(freqs)
+        ghz = freqs / 1e9
+        f_lo, f_hi = p['band']
+
+        rolloff = 20 * np.log10(1 / np.sqrt(1 + ((f_lo / ghz) ** 8))) + 20 * np.log10(1 / np.sqrt(1 + ((ghz / f_hi) ** 8)))
+        s21 = p['loss_db'] + rolloff
+        s12 = s21 - 30
+        s11 = -15 + 3 * np.cos(ghz * 2)
+        s22 = -14 + 3 * np.sin(ghz * 2)
+        phase = -360 * freqs * p['delay_ns'] * 1e-9
+
+        def db(x):
+            return x + rnd.normal(0, p['noise_db'] * scale, points)
+
+        def deg(x):
+            return (x + rnd.normal(0, p['noise_deg'] * scale, points) + 180) % 360 - 180
+
+        rows = [freqs, db(s11), deg(phase / 4), db(s21), deg(phase), db(s12), deg(phase), db(s22), deg(phase / 3)]
+        return np.concatenate(rows)
+
+
+class SimSource(SimInstrument):
+
+    def __init__(self, bench):
+        super().__init__(bench, 'Source')
+        self._selected = 'P6V'
+        self._outputs = set()
+
+    def _handle(self, command):
+        words = command.split()
+        cmd = words[0].upper() if words else ''
+        arg = ' '.join(words[1:]).upper()
+        if cmd in ('INST:SEL', 'INST'):
+            self._selected = arg
+        elif cmd == 'OUTP':
+            if arg == 'ON':
+                self._outputs.add(self._selected)
+            else:
+                self._outputs.discard(self._selected)
+            self._bench.powered = bool(self._outputs)
+            self._bench.power_changed = time.perf_counter()
+        elif cmd == 'APPLY':
+            # DUT comes up unprogrammed when supplied at the nominal check voltage
+            if _parse_voltage(arg) > self._bench.profile['reset_voltage']:
+                self._bench.programmed = False
+            self._bench.power_changed = time.perf_counter()
+        elif cmd == 'MEAS:CURR?':
+            share = 0.2 if arg == 'P6V' else 0.8
+            return self._bench.supply_current() * share
+        return super()._handle(command)
+
+
+class SimProgrammer:
+
+    def __init__(self, bench):
+        self._bench = bench
+        self.status = 'Программатор (симулятор)'
+
+    def __str__(self):
+        return self.status
+
+    def query(self, question):
+        self._bench.wait(self._bench.profile['programmer_latency'])
+        self._bench.programmed = True
+        self._bench.power_changed = time.perf_counter()
+        return question
+
+    def set_lpf_code(self, code):
+        self._bench.wait(self._bench.profile['programmer_latency'])
+        self._bench.lpf_code = code
+
+    def ping(self):
+        return True
+
+
+class SimFactory:
+
+    def __init__(self, cls, bench, addr='SIM'):
+        self._cls = cls
+        self._bench = bench
+        self.addr = addr
+        self._instance = None
+        self._lock = threading.Lock()
+
+    def find(self):
+        with self._lock:
+            if self._instance is None:
+                self._instance = self._cls(self._bench)
+            return self._instance
+
+
+def simulated_instruments(profile='default', seed=None):
+    bench = SimBench(profile, seed)
+    return {
+        'Анализатор': SimFactory(SimAnalyzer, bench, 'SIM::PNA'),
+        'Источник 1': SimFactory(SimSource, bench, 'SIM::SRC'),
+        'Программатор': SimFactory(SimProgrammer, bench, 'SIM::COM'),
+    }
+
+
+def _parse_freq(value):
+    value = value.strip().upper()
+    for suffix, mul in (('GHZ', 1e9), ('MHZ', 1e6), ('KHZ', 1e3), ('HZ', 1)):
+        if value.endswith(suffix):
+            return float(value[:-len(suffix)]) * mul
+    return float(value)
+
+
+def _parse_segments(value):
+    # 'SSTOP,<count>,<state>,<points>,<start>,<stop>,...' -> [(points, start, stop), ...] of the enabled segments
+    parts = value.split(',')
+    count = int(parts[1])
+    rows = [parts[2 + 4 * i:6 + 4 * i] for i in range(count)]
+    return [(int(n), _parse_freq(start), _parse_freq(stop)) for state, n, start, stop in rows if int(state)]
+
+
+def _parse_voltage(value):
+    # 'P6V,3.15V,5MA' -> 3.15
+    parts = value.split(',')
+    return float(parts[1].strip().upper().rstrip('V')) if len(parts) > 1 else 0.0
+
+
+def run_benchmark(controller, device, runs=10):
+    # end-to-end check + measure cycles through InstrumentController against the simulator
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        controller._check(device, controller.secondaryParams)
+        controller._measure(device, controller.secondaryParams)
+        timings.append(time.perf_counter() - start)
+    print(f'{runs} runs: mean {sum(timings) / runs:.3f} s, min {min(timings):.3f} s, max {max(timings):.3f} s')
+    return timings
+
+
+if __name__ == '__main__':
+    import sys
+    from instrumentcontroller import InstrumentController
+
+    ctrl = InstrumentController()
+    ctrl.use_simulator(sys.argv[1] if len(sys.argv) > 1 else 'default')
+    ctrl.connect(dict())
+    run_benchmark(ctrl, next(iter(ctrl.deviceParams)))
@@ -0,0 +1,106 @@
+import math
+
+import numpy as np
+
+
+# bytes per trace value on the bus for every transfer format, ASCII is '-1.234567e+00,'
+value_size = {'ASCII': 14, 'REAL,32': 4, 'REAL,64': 8}
+
+# analyzer settings the optimizer picks from
+standard_points = (51, 101, 201, 401, 801, 1601, 3201)
+standard_ifbw = (10, 30, 100, 300, 1000, 3000, 10000, 30000, 100000)
+
+
+class SweepModel:
+    # time of one DUT, s:
+    #   settle + states * reads * (sweep + transfer)
+    #   sweep = sweep_overhead + points * (ifbw_factor / ifbw + point_overhead)
+    #   transfer = latency + points * 9 rows * value_size / bus_rate
+    # trace noise of one sweep (dB, deg) goes as sqrt(ifbw), the mean of n sweeps divides it by sqrt(n)
+
+    def __init__(self, sweep_overhead=0.01, ifbw_factor=1.2, point_overhead=0.00002, latency=0.002,
+                 bus_rate=1_000_000, settle=0.05, noise=(0.02, 0.2), noise_ifbw=1000):
+        self.sweep_overhead = sweep_overhead
+        self.ifbw_factor = ifbw_factor
+        self.point_overhead = point_overhead
+        self.latency = latency
+        self.bus_rate = bus_rate
+        self.settle = settle
+        self.noise_ref = tuple(noise)
+        self.noise_ifbw = noise_ifbw
+
+    def sweep_time(self, points, ifbw):
+        return self.sweep_overhead + points * (self.ifbw_factor / ifbw + self.point_overhead)
+
+    def transfer_time(self, points, fmt='REAL,64'):
+        return self.latency + points * 9 * value_size[fmt] / self.bus_rate
+
+    def noise(self, ifbw, reads=1):
+        scale = math.sqrt(ifbw / self.noise_ifbw / reads)
+        return tuple(n * scale for n in self.noise_ref)
+
+    def estimate(self, points, ifbw, states=1, reads=1, fmt='REAL,64'):
+        return self.settle + states * reads * (self.sweep_time(points, ifbw) + self.transfer_time(points, fmt))
+
+    def calibrate(self, sweep_log, settle_log=()):
+        # fits the model to InstrumentController.sweep_log / settle_log, terms the log cannot
+        # separate (a single setup measured) are scaled as a whole instead; runs in the 'sleep'
+        # sync mode are skipped, their fixed delays say nothing about the sweep itself
+        runs = [e for e in sweep_log if e.get('points') and e.get('sweeps') and e['mode'] != 'sleep']
+        if runs:
+            self._fit_sweep(runs)
+            self._fit_transfer(runs)
+            noisy = [e for e in runs if e.get('noise')]
+            if noisy:
+                refs = np.array([np.asarray(e['noise']) * math.sqrt(self.noise_ifbw / e['ifbw']) for e in noisy])
+                self.noise_ref = tuple(refs.mean(axis=0).tolist())
+        if settle_log:
+            self.settle = float(np.mean([e['before'] + e['after'] for e in settle_log]))
+        return self
+
+    def _fit_sweep(self, runs):
+        features = np.array([[1, e['points'] / e['ifbw'], e['points']] for e in runs], dtype=float)
+        times = np.array([e['sync'] / e['sweeps'] for e in runs])
+        if np.linalg.matrix_rank(features) == features.shape[1]:
+            coef = np.linalg.lstsq(features, times, rcond=None)[0].clip(min=0)
+            self.sweep_overhead, self.ifbw_factor, self.point_overhead = coef.tolist()
+        else:
+            scale = float(times.sum()) / sum(self.sweep_time(e['points'], e['ifbw']) for e in runs)
+            self.sweep_overhead *= scale
+            self.ifbw_factor *= scale
+            self.point_overhead *= scale
+
+    def _fit_transfer(self, runs):
+        features = np.array([[1, e['points'] * 9 * value_size[e['format']]] for e in runs], dtype=float)
+        times = np.array([max(e['total'] - e['sync'], 0) / e['reads'] for e in runs])
+        coef = None
+        if np.linalg.matrix_rank(features) == features.shape[1]:
+            coef = np.linalg.lstsq(features, times, rcond=None)[0].tolist()
+        if coef is not None and coef[1] > 0:
+            self.latency, self.bus_rate = max(coef[0], 0.0), 1 / coef[1]
+        else:
+            scale = float(times.sum()) / sum(self.transfer_time(e['points'], e['format']) for e in runs)
+            self.latency *= scale
+            self.bus_rate /= scale or 1
+
+    def optimize(self, target_noise, states=1, min_points=201, max_reads=16, fmt='REAL,64',
+                 points=standard_points, ifbws=standard_ifbw):
+        # fastest points / IF bandwidth / sweep count meeting target_noise (dB, deg) with at least
+        # min_points on the grid, None if no setup gets there within max_reads sweeps
+        best = None
+        for p in (p for p in points if p >= min_points):
+            for ifbw in ifbws:
+                single = self.noise(ifbw)
+                reads = max(1, *(math.ceil((n / t) ** 2) for n, t in zip(single, target_noise)))
+                if reads > max_reads:
+                    continue
+                setup = {
+                    'points': p,
+                    'ifbw': ifbw,
+                    'reads': reads,
+                    'noise': self.noise(ifbw, reads),
+                    'time': self.estimate(p, ifbw, states, reads, fmt),
+                }
+                if best is None or setup['time'] < best['time']:
+                    best = setup
+        return best
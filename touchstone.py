@@ -0,0 +1,64 @@
+import os
+
+import numpy as np
+
+
+# parsed adjust sets kept for the lifetime of the process, keyed by directory
+_sets = dict()
+
+cache_name = 's2p_cache.npz'
+
+
+def read_s2p(path, header_lines=5, columns=9):
+    # the header is skipped and the rest of the file goes through a single vectorized
+    # text-to-float conversion instead of a per line split
+    with open(path, mode='rt', encoding='utf-8') as f:
+        for _ in range(header_lines):
+            if not f.readline():
+                return np.empty((columns, 0))
+        values = np.fromstring(f.read(), sep=' ')
+    return values.reshape(-1, columns).T
+
+
+def set_files(directory, count=64):
+    return [os.path.join(directory, f's{i}.s2p') for i in range(count)]
+
+
+def load_set(directory, count=64):
+    # (count x columns x points) array for s0.s2p .. s{count-1}.s2p, cached in memory
+    # and in a sidecar file next to the set, both invalidated by the file mtimes
+    files = set_files(directory, count)
+    stamps = np.array([os.stat(f).st_mtime_ns for f in files], dtype=np.int64)
+
+    cached = _sets.get(directory)
+    if cached is not None and np.array_equal(cached[0], stamps):
+        return cached[1]
+
+    data = _read_sidecar(directory, stamps)
+    if data is None:
+        # parsing holds the GIL, the set is read file by file; repeated loads come from the caches
+        data = np.stack([read_s2p(f) for f in files])
+        _write_sidecar(directory, stamps, data)
+
+    _sets[directory] = (stamps, data)
+    return data
+
+
+def _read_sidecar(directory, stamps):
+    path = os.path.join(directory, cache_name)
+    if not os.path.isfile(path):
+        return None
+    try:
+        with np.load(path) as f:
+            if np.array_equal(f['stamps'], stamps):
+                return f['data']
+    except (OSError, KeyError, ValueError):
+        pass
+    return None
+
+
+def _write_sidecar(directory, stamps, data):
+    try:
+        np.savez(os.path.join(directory, cache_name), stamps=stamps, data=data)
+    except OSError as ex:
+        print(f'could not write adjust set cache: {ex}')